@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+#
+# columnar.py - export read results to Parquet/Arrow/NPY files; bulk load such files
+#
+# A file holds one "ns" column (seconds) and one float64 column per sensor; "ns"
+# is int64 in Parquet/Arrow and float64 in NPY (one '<f8' matrix; exact for
+# seconds below 2**53, loads convert it back to int);
+# sensor labels are stored as file metadata (schema metadata for Parquet/Arrow,
+# a "<path>.json" sidecar for NPY). pyarrow is required only for Parquet/Arrow,
+# numpy - only for loading NPY files.
+#
+
+from __future__ import print_function
+import os, sys, json, struct, array
+
+EXPORT_FORMATS = ['parquet', 'arrow', 'npy']
+FORMAT_EXTENSIONS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+    '.npy': 'npy'
+}
+LOAD_BATCH = 50000
+
+#############################################################################
+# Columns
+
+def column_names(sensors):
+    return ['ns'] + [str(s) for s in sensors]
+
+def to_float(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return float('nan')
+    return float(v)
+
+def align_columns(dataset, sensors):
+    rows = {}
+    for sensor, values in dataset.items():
+        for record in values:
+            rows.setdefault(record['ns'], {})[str(sensor)] = record['value']
+    ns = sorted(rows)
+    cols = {}
+    for s in sensors:
+        s = str(s)
+        cols[s] = [to_float(rows[t].get(s)) for t in ns]
+    return ns, cols
+
+#############################################################################
+# Writers
+
+class NpyWriter(object):
+    # The header is reserved with a fixed size and rewritten with the final
+    # shape on close, so rows are appended without knowing their number.
+    HEADER_SIZE = 128
+
+    def __init__(self, path, sensors, labels):
+        self.path = path
+        self.columns = column_names(sensors)
+        self.rows = 0
+        self.fd = open(path, 'wb')
+        self.fd.write(self.header())
+        with open(path + '.json', 'w') as fd:
+            json.dump({'columns': self.columns, 'labels': labels}, fd, indent=4)
+
+    def header(self):
+        d = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (self.rows, len(self.columns))
+        pad = self.HEADER_SIZE - 10 - len(d) - 1
+        assert pad >= 0, d
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', self.HEADER_SIZE - 10) + (d + ' ' * pad + '\n').encode('latin1')
+
+    def write(self, ns, cols):
+        names = self.columns[1:]
+        buf = array.array('d')
+        for i, t in enumerate(ns):
+            buf.append(float(t))
+            for name in names:
+                buf.append(cols[name][i])
+        if sys.byteorder != 'little':
+            buf.byteswap()
+        buf.tofile(self.fd)
+        self.rows += len(ns)
+
+    def close(self):
+        self.fd.seek(0)
+        self.fd.write(self.header())
+        self.fd.close()
+
+
+class ArrowWriter(object):
+    def __init__(self, path, sensors, labels, fmt):
+        import pyarrow
+        self.pa = pyarrow
+        self.columns = column_names(sensors)
+        fields = [pyarrow.field('ns', pyarrow.int64())] + [pyarrow.field(name, pyarrow.float64()) for name in self.columns[1:]]
+        self.schema = pyarrow.schema(fields, metadata={'labels': json.dumps(labels)})
+        if fmt == 'parquet':
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, ns, cols):
+        arrays = [self.pa.array(ns, type=self.pa.int64())] + [
+            self.pa.array(cols[name], type=self.pa.float64()) for name in self.columns[1:]]
+        batch = self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if hasattr(self.writer, 'write_batch'):
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, fmt, sensors, labels = {}):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("unknown export format: %s" % fmt)
+    if fmt == 'npy':
+        return NpyWriter(path, sensors, labels)
+    return ArrowWriter(path, sensors, labels, fmt)
+
+#############################################################################
+# Export
+
+def export_chunks(chunks, path, fmt, sensors, labels = {}, verbose = False):
+    # chunks: (w1, w2, values) as yielded by utils.iter_columns
+    writer = open_writer(path, fmt, sensors, labels)
+    total = 0
+    try:
+        for (w1, w2, dataset) in chunks:
+            ns, cols = align_columns(dataset, sensors)
+            if ns:
+                writer.write(ns, cols)
+            total += len(ns)
+            if verbose:
+                print("export [%d, %d): %d rows" % (w1, w2, len(ns)))
+    finally:
+        writer.close()
+    return total
+
+def export_dataset(dataset, path, fmt, labels = {}):
+    # numeric sensor ids first, in numeric order, then the others by name
+    sensors = sorted(dataset.keys(), key=lambda s: (not str(s).isdigit(), int(s) if str(s).isdigit() else 0, str(s)))
+    return export_chunks([(0, 0, dataset)], path, fmt, sensors, labels)
+
+#############################################################################
+# Load
+#
+# Files are memory-mapped and sliced into record batches without copying, so
+# only one batch is resident at a time. This is not a zero-copy hand-off:
+# inserts are JSON, so every batch is copied once into Python lists
+# (to_pylist/tolist) to build its payload.
+
+def file_format(path):
+    return FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+def npy_column_names(path, n):
+    if os.path.isfile(path + '.json'):
+        with open(path + '.json') as fd:
+            return json.load(fd)['columns']
+    return ['ns'] + [str(i) for i in range(n - 1)]
+
+def batch_columns(batch):
+    return {name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)}
+
+def iter_batches(path, fmt = None, batch_size = LOAD_BATCH):
+    fmt = fmt or file_format(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size):
+            yield batch_columns(batch)
+    elif fmt == 'arrow':
+        import pyarrow, pyarrow.ipc
+        with pyarrow.memory_map(path) as source:
+            reader = pyarrow.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for offset in range(0, batch.num_rows, batch_size):
+                    yield batch_columns(batch.slice(offset, batch_size))
+    elif fmt == 'npy':
+        import numpy
+        a = numpy.load(path, mmap_mode='r')
+        names = npy_column_names(path, a.shape[1])
+        for offset in range(0, a.shape[0], batch_size):
+            block = a[offset:offset + batch_size]
+            yield {name: block[:, i].tolist() for i, name in enumerate(names)}
+    else:
+        raise ValueError("unknown file format: %s" % path)
+
+def is_value(v):
+    return v is not None and v == v # NaN is a missing value
+
+def measurement_payload(cols, measurement, ns_col = 'ns', value_col = 'value', series_cols = [], series = {}):
+    ns, values = cols[ns_col], cols[value_col]
+    data = []
+    for i in range(len(ns)):
+        if not is_value(values[i]):
+            continue
+        d = {'ns': int(ns[i]), 'value': values[i]}
+        if series_cols:
+            d['series'] = {c: cols[c][i] for c in series_cols}
+        data.append(d)
+    return [{
+        'measurement': measurement,
+        'series': series,
+        'data': data
+    }]
+
+def swimlane_payload(cols, key, ns_col = 'ns'):
+    sensors = [c for c in cols if c != ns_col]
+    data = []
+    for i, t in enumerate(cols[ns_col]):
+        p = {s: cols[s][i] for s in sensors if is_value(cols[s][i])}
+        p['ns'] = int(t)
+        data.append(p)
+    return [{
+        'key': key,
+        'data': data
+    }]
+
+def load_file(client, path, payload_f, fmt = None, batch_size = LOAD_BATCH, verbose = False):
+    total = 0
+    for cols in iter_batches(path, fmt, batch_size):
+        payload = payload_f(cols)
+        (ok, r) = client.insert(payload)
+        assert ok == 'ok', (ok, r)
+        total += sum([len(p['data']) for p in payload])
+        if verbose:
+            print("sent %d records" % total)
+    return total
+
+#############################################################################
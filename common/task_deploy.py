@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+#
+# task_deploy.py - idempotent deployment of server-side task scripts
+#
+# A unit is a rendered task script: one or more tasks with their helper
+# functions. The fingerprint of a unit (SHA-1 of the rendered text) is added
+# to the options of each of its tasks. A deploy reads user_tasks() and
+# get_task() of the unit's tasks and posts the unit only if a task is missing
+# ("create") or has another fingerprint ("replace": its tasks are deleted
+# first); managed tasks of no unit are deleted. Deploys to many users run
+# concurrently.
+#
+
+from __future__ import print_function
+import re, hashlib, collections
+
+from utils import (ConnectionError, imap_concurrently)
+
+FINGERPRINT = "fingerprint"
+TASK_NAME_RE = re.compile(r'^\s*task\s+"([^"]+)"', re.M)
+OPTIONS_RE = re.compile(r'\boptions:\s*#\{(\s*\})?')
+
+#############################################################################
+
+def fingerprint(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+def task_names(text):
+    return TASK_NAME_RE.findall(text)
+
+def stamp(text, fp):
+    def add(m):
+        if m.group(1):
+            return 'options: #{"%s": "%s"}' % (FINGERPRINT, fp)
+        return 'options: #{\n        "%s": "%s",' % (FINGERPRINT, fp)
+    return OPTIONS_RE.sub(add, text)
+
+def find_key(d, key):
+    # the value of key anywhere in a get_task() record
+    if isinstance(d, dict):
+        if key in d:
+            return d[key]
+        d = list(d.values())
+    if isinstance(d, list):
+        for v in d:
+            found = find_key(v, key)
+            if found is not None:
+                return found
+    return None
+
+
+def plan(client, units, managed = ()):
+    # units: {unit: rendered text} -> [(action, unit or task, task names)]
+    (ok, tasks) = client.query("user_tasks().")
+    assert ok == 'ok', (ok, tasks)
+    actions = []
+    wanted = set()
+    for unit, text in sorted(units.items()):
+        names = task_names(text)
+        wanted.update(names)
+        fp = fingerprint(text)
+        deployed = []
+        for name in names:
+            if name in tasks:
+                (ok, r) = client.query("""get_task("%s").""" % name)
+                assert ok == 'ok', (ok, r)
+                deployed.append(find_key(r, FINGERPRINT))
+            else:
+                deployed.append(None)
+        if deployed and all([d == fp for d in deployed]):
+            actions.append(('keep', unit, names))
+        elif any([name in tasks for name in names]):
+            actions.append(('replace', unit, [name for name in names if name in tasks]))
+        else:
+            actions.append(('create', unit, []))
+    for name in sorted(set(managed) - wanted):
+        if name in tasks:
+            actions.append(('delete', name, [name]))
+    return actions
+
+def apply(client, units, actions, verbose = False):
+    for (action, unit, names) in actions:
+        if action == 'keep':
+            continue
+        for name in names:
+            (ok, r) = client.query("""delete_task("%s").""" % name)
+            assert ok == 'ok', (ok, r)
+        if action in ('create', 'replace'):
+            text = stamp(units[unit], fingerprint(units[unit]))
+            if verbose:
+                print(text)
+            (ok, r) = client.query(text)
+            assert ok == 'ok', (ok, r)
+
+def deploy(client, units, managed = (), dry_run = False, verbose = False):
+    # -> Counter of actions
+    actions = plan(client, units, managed)
+    if not dry_run:
+        apply(client, units, actions, verbose)
+    if verbose:
+        for (action, unit, names) in actions:
+            print("%s %s %s" % (action, unit, ", ".join(names)))
+    return collections.Counter([action for (action, _, _) in actions])
+
+def deploy_all(targets, render, managed = (), workers = 8, dry_run = False, verbose = False):
+    # targets: [(name, client)], render(client) -> units; yields (name, Counter of actions or an error)
+    def run(target):
+        (name, client) = target
+        try:
+            return (name, deploy(client, render(client), managed, dry_run, verbose))
+        except (AssertionError, ConnectionError) as e:
+            return (name, e)
+    for r in imap_concurrently(run, targets, workers):
+        yield r
+
+def report(results):
+    totals = collections.Counter()
+    errors = 0
+    for (name, r) in results:
+        if isinstance(r, collections.Counter):
+            totals.update(r)
+            print("%s: %s" % (name, ", ".join(["%s %d" % kv for kv in sorted(r.items())]) or "nothing to do"))
+        else:
+            errors += 1
+            print("%s: ERROR: %s" % (name, r))
+    print("deployed: %s, errors: %d" % (", ".join(["%s %d" % kv for kv in sorted(totals.items())]) or "nothing", errors))
+    return errors == 0
+
+#############################################################################
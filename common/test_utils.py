@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+#
+# test_utils.py - tests of the utils helpers that run without a server
+#
+# python -m pytest common
+#
+
+import os, sys, io
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+pytest.importorskip("mdtsdb")
+import utils
+
+#############################################################################
+
+def json_values(text, chunk_size = utils.JSON_CHUNK):
+    return list(utils.iter_json_values(io.StringIO(text), chunk_size))
+
+@pytest.mark.parametrize("chunk_size", [1, 3, utils.JSON_CHUNK])
+def test_json_array(chunk_size):
+    assert json_values(' [ {"a": 1}, {"b": [2, 3]} ,4 ] ', chunk_size) == [{"a": 1}, {"b": [2, 3]}, 4]
+    assert json_values('[]', chunk_size) == []
+
+@pytest.mark.parametrize("chunk_size", [1, 3, utils.JSON_CHUNK])
+def test_json_stream(chunk_size):
+    assert json_values('{"a": 1}\n{"b": 2}\n', chunk_size) == [{"a": 1}, {"b": 2}]
+
+@pytest.mark.parametrize("chunk_size", [1, 3, utils.JSON_CHUNK])
+def test_json_truncated_array(chunk_size):
+    with pytest.raises(ValueError):
+        json_values('[{"a": 1}, {"b": 2}', chunk_size)
+    with pytest.raises(ValueError):
+        json_values('[{"a": 1}, {"b": 2},', chunk_size)
+
+@pytest.mark.parametrize("chunk_size", [1, 3, utils.JSON_CHUNK])
+def test_json_missing_separator(chunk_size):
+    with pytest.raises(ValueError):
+        json_values('[1 2]', chunk_size)
+    with pytest.raises(ValueError):
+        json_values('[{"a": 1} {"b": 2}]', chunk_size)
+
+#############################################################################
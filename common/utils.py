@@ -6,13 +6,16 @@
 from __future__ import print_function
 from mdtsdb import Mdtsdb
 from mdtsdb.exceptions import ConnectionError
-import os, sys, json, csv, time, datetime, calendar
+import os, sys, re, json, csv, time, math, datetime, calendar, collections
 
 if sys.version_info >= (3,5,0):
     from _thread import *
+    import queue
 else:
     from thread import *
-import kafka, threading
+    import Queue as queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 HOST = "time-engine.qee.qomplxos.com"
 PORT = 443
@@ -203,6 +206,56 @@ def import_csv(args, filename):
 
     return header, body, max_sensor, labels, stationary, data
 
+#############################################################################
+# JSON
+
+JSON_CHUNK = 1 << 20
+JSON_SPACE = re.compile(r'\s*')
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+def iter_json_values(fd, chunk_size = JSON_CHUNK):
+    # Yields the elements of a top-level JSON array, or the values of a stream
+    # of JSON values (NDJSON), reading the file by chunks. A value split
+    # between chunks is decoded again when the next chunk arrives; the read size
+    # grows with the buffer, so a large value is not re-decoded too many times.
+    # An array without its closing ] or with elements not separated by , is an
+    # error (ValueError), so a truncated file is not taken for a complete one.
+    decoder = json.JSONDecoder()
+    buf, pos, eof, in_array, expect = '', 0, False, None, 'value'
+    while True:
+        pos = (JSON_SPACE if in_array else JSON_SEPARATORS).match(buf, pos).end()
+        if pos < len(buf):
+            if in_array is None:
+                in_array = buf[pos] == '['
+                if in_array:
+                    (pos, expect) = (pos + 1, 'first')
+                    continue
+            if in_array:
+                if buf[pos] == ']' and expect != 'value':
+                    return
+                if expect == 'separator':
+                    if buf[pos] != ',':
+                        raise ValueError("missing , in JSON array near: %s" % buf[pos:pos + 80])
+                    (pos, expect) = (pos + 1, 'value')
+                    continue
+            try:
+                (value, end) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            if end is not None and (end < len(buf) or eof):
+                yield value
+                (pos, expect) = (end, 'separator')
+                continue
+            if eof:
+                raise ValueError("malformed JSON near: %s" % buf[pos:pos + 80])
+        elif eof:
+            if in_array:
+                raise ValueError("truncated JSON array: no closing ]")
+            return
+        chunk = fd.read(max(chunk_size, len(buf) - pos))
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
 #############################################################################
 # Numerical data: write
 
@@ -235,6 +288,112 @@ def write_num(args, swimlane, packs, sensors, n, gen_f = None, delay_f = None):
     t2 = ti
     return t0, t2
 
+def insert_batches(payloads, batch):
+    # Re-packs insert payloads into batches of at most `batch` data records;
+    # large payloads are split in several batches.
+    out, n = [], 0
+    for payload in payloads:
+        data, start = payload['data'], 0
+        while start < len(data):
+            size = min(batch - n, len(data) - start)
+            fragment = dict(payload)
+            fragment['data'] = data[start:start + size]
+            out.append(fragment)
+            n += size
+            start += size
+            if n >= batch:
+                yield out
+                out, n = [], 0
+    if out:
+        yield out
+
+#############################################################################
+# Numerical data: read
+#
+# Paged reads: a [t1, t2) range is split into time windows and every window is
+# fetched by a separate query, so only one window of a response is held in
+# memory at a time. The "to" bound of a query is inclusive, so a window is
+# queried up to one second before the next window starts.
+
+READ_WINDOW = 86400
+
+def time_bound(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(t))
+
+def read_windows(t1, t2, window = READ_WINDOW):
+    t = t1
+    while t < t2:
+        yield (t, min(t + window, t2))
+        t += window
+
+def read_window_query(sensors, w1, w2, fmt, sw = None):
+    if isinstance(sensors, int):
+        sensors = "$0-$%d" % (sensors - 1)
+    return """
+        %s
+        select %s
+            from "%s" to "%s"
+            format %s
+        end.
+    """ % ('use("%s"),' % sw if sw else "", sensors, time_bound(w1), time_bound(w2), fmt)
+
+def iter_columns(client, sensors, t1, t2, window = READ_WINDOW, sw = None):
+    for (w1, w2) in read_windows(t1, t2, window):
+        (ok, r) = client.query(read_window_query(sensors, w1, w2 - 1, "json (array: true)", sw))
+        assert ok == 'ok' and 'data' in r and 'values' in r['data'][0], (ok, r)
+        yield (w1, w2, r['data'][0]['values'])
+
+#############################################################################
+# Concurrency
+
+def clone_client(client):
+    secret_key = client.secret_key.decode() if isinstance(client.secret_key, bytes) else client.secret_key
+    if getattr(client, 'app_key', None):
+        keys = {'app_key': client.app_key}
+    else:
+        keys = {'admin_key': client.admin_key}
+    return Mdtsdb(
+        host=HOST,
+        port=PORT,
+        secret_key=secret_key,
+        timeout=REQ_TIMEOUT,
+        is_https=ISHTTPS,
+        **keys)
+
+def client_pool(client):
+    # one connection per worker thread
+    local = threading.local()
+    def get():
+        if not hasattr(local, 'client'):
+            local.client = clone_client(client)
+        return local.client
+    return get
+
+def imap_concurrently(f, items, workers):
+    # Yields f(item) in the order of items; at most 2 * workers items are in
+    # flight, so a lazy sequence of items is consumed with bounded memory.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(f, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def percentile(sorted_values, p):
+    i = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(i, len(sorted_values) - 1))]
+
+def latency_report(samples_ms, ps = (50, 90, 95, 99)):
+    if not samples_ms:
+        return "no samples"
+    values = sorted(samples_ms)
+    return ", ".join(
+        ["min: %.1f" % values[0]] +
+        ["p%d: %.1f" % (p, percentile(values, p)) for p in ps] +
+        ["max: %.1f" % values[-1], "mean: %.1f ms" % (sum(values) / len(values))])
+
 #############################################################################
 # Kafka
 
@@ -249,6 +408,7 @@ class KafkaConsumer(threading.Thread):
         self.msgs = []
 
     def run(self):
+        import kafka
         kafka_topics = self.kafka_topic.split(';')
         if len(kafka_topics) == 1:
             consumer = kafka.KafkaConsumer(
@@ -269,7 +429,138 @@ class KafkaConsumer(threading.Thread):
                 break
         consumer.close()
 
-    def topics():
+    def topics(self):
+        import kafka
         return kafka.KafkaConsumer(bootstrap_servers=['%s:%d' % (self.kafka_server, self.kafka_port)]).topics()
 
+
+class KafkaStream(object):
+    # Reads topics (separated by ;) with batched polls. With a group_id, the
+    # partitions are shared by the consumers of the group: by the `consumers`
+    # threads here and by other processes with the same group_id. Records are
+    # decoded by decode(record) in a pool of `workers` threads (msg.value if
+    # no decode), in order within a batch, and go to callback(msg) or to a
+    # queue of at most `queue_size` messages, so polls wait for a slow reader.
+    # The stream ends after n_msgs messages, after wait_ms without messages
+    # (None - never) or on stop().
+    END = object()
+
+    def __init__(self, kafka_server, kafka_port, kafka_topic, group_id = None, consumers = 1,
+                 max_records = 500, fetch_max_bytes = 50 * 1024 * 1024, decode = None, workers = 4,
+                 queue_size = 10000, callback = None, n_msgs = None, wait_ms = None):
+        assert consumers == 1 or group_id, "several consumers need a group_id"
+        self.kafka_server = kafka_server
+        self.kafka_port = kafka_port
+        self.kafka_topics = kafka_topic.split(';')
+        self.group_id = group_id
+        self.consumers = consumers
+        self.max_records = max_records
+        self.fetch_max_bytes = fetch_max_bytes
+        self.decode = decode
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        self.callback = callback
+        self.n_msgs = n_msgs
+        self.wait_ms = wait_ms
+        self.stopped = threading.Event()
+        self.done = threading.Event()       # n_msgs are read: polls end, deliveries finish
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.pool = None
+
+    def start(self):
+        if self.decode and self.workers > 0:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.threads = [threading.Thread(target=self.poll) for _ in range(self.consumers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+        t = threading.Thread(target=self.finish)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        for t in self.threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.time()))
+
+    def finish(self):
+        for t in self.threads:
+            t.join()
+        if self.pool:
+            self.pool.shutdown()
+        if not self.callback:
+            self.queue.put(KafkaStream.END)
+
+    def consumer(self):
+        import kafka
+        consumer = kafka.KafkaConsumer(
+            bootstrap_servers='%s:%d' % (self.kafka_server, self.kafka_port),
+            group_id=self.group_id,
+            max_poll_records=self.max_records,
+            fetch_max_bytes=self.fetch_max_bytes)
+        consumer.subscribe(topics=self.kafka_topics)
+        return consumer
+
+    def deliver(self, msgs):
+        for m in msgs:
+            if self.callback:
+                self.callback(m)
+                continue
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(m, timeout=0.1)
+                    break
+                except queue.Full:
+                    with self.lock:
+                        self.stats['queue_full'] += 1
+
+    def poll(self):
+        consumer = self.consumer()
+        idle = time.time()
+        try:
+            while not self.stopped.is_set() and not self.done.is_set():
+                batch = consumer.poll(timeout_ms=100, max_records=self.max_records)
+                records = [r for rs in batch.values() for r in rs]
+                if not records:
+                    if self.wait_ms is not None and 1000 * (time.time() - idle) >= self.wait_ms:
+                        break
+                    continue
+                idle = time.time()
+                with self.lock:
+                    if self.n_msgs:
+                        records = records[:max(0, self.n_msgs - self.stats['msgs'])]
+                    if not records:
+                        # another consumer has read the last of n_msgs
+                        break
+                    self.stats['msgs'] += len(records)
+                    self.stats['batches'] += 1
+                    self.stats['bytes'] += sum([len(r.value or b'') for r in records])
+                if self.pool:
+                    msgs = list(self.pool.map(self.decode, records))
+                elif self.decode:
+                    msgs = [self.decode(r) for r in records]
+                else:
+                    msgs = [r.value for r in records]
+                self.deliver(msgs)
+                with self.lock:
+                    if self.n_msgs and self.stats['msgs'] >= self.n_msgs:
+                        self.done.set()
+        finally:
+            consumer.close()
+
+    def __iter__(self):
+        # the messages of the queue until the stream ends
+        while True:
+            m = self.queue.get()
+            if m is KafkaStream.END:
+                self.queue.put(m)
+                return
+            yield m
+
 #############################################################################
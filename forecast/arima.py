@@ -3,7 +3,7 @@
 # arima.py - simple ARMA forecast model
 #
 
-import argparse, os, sys, csv, json, time
+import argparse, os, sys, csv, json, time, calendar
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 import utils
@@ -11,7 +11,9 @@ from utils import (new_user, new_swimlane,
                    ConnectionError,
                    create_clients, update_clients, open_creds,
                    clean, print_info,
-                   import_csv, country_label, HOST, PORT, ISHTTPS)
+                   import_csv, country_label, iter_columns, time_bound,
+                   HOST, PORT, ISHTTPS)
+from columnar import export_chunks, EXPORT_FORMATS
 
 CREDS = 'arima.json'
 CSV = 'covid_time_series.csv'
@@ -91,6 +93,22 @@ def read(args, creds):
     print(json.dumps(r, indent=4))
 
 
+def export(args, creds):
+    r = create_clients(args.test, creds)
+    if r is None:
+        raise ValueError("unknown test scenario: %d" % args.test)
+
+    (user, swimlane, attrs) = r
+    max_sensor, labels = creds['info']['max_sensor'], creds['info']['labels']
+    t1 = calendar.timegm(time.strptime(args.export_from, "%Y-%m-%d"))
+    t2 = calendar.timegm(time.strptime(args.export_to, "%Y-%m-%d")) if args.export_to else int(time.time())
+
+    ms0 = time.time()
+    chunks = iter_columns(swimlane, max_sensor, t1, t2, args.read_window)
+    total = export_chunks(chunks, args.export, args.export_format, range(max_sensor), labels, args.verbose)
+    print("OK: %d rows are exported to %s, elapsed: %ss" % (total, args.export, round((time.time() - ms0) * 1000) / 1000.0))
+
+
 def validate(args, creds):
     r = create_clients(args.test, creds)
     if r is None:
@@ -103,29 +121,21 @@ def validate(args, creds):
 
 def validate1(args, user, swimlane):
     header, body, max_sensor, labels, stationary, data = import_csv(args, CSV)
-    resp = swimlane.query("select $0-$%d format json (array: true) end." % (max_sensor - 1))
-    (ok, r) = resp
-    assert ok == 'ok' and 'data' in r and 'values' in r['data'][0], (ok, r)
-    dataset = r['data'][0]['values']
-
-    for sensor, values in dataset.items():
-        no = int(sensor)
-        d = body[no]
-        label = country_label(d)
-        assert label == labels[sensor]
-        i = 0
-        for record in values:
-            assert data[i][sensor] == record["value"], (data[i][sensor], record["value"])
-            i += 1
-
-    if args.verbose:
-        r['data'][0]['values'] = {}
-        print("Server read details:")
-        print(json.dumps(r, indent=4))
-    try:
-        print("server read time: %d ms" % r['data'][0]['ms'])
-    except KeyError:
-        pass
+    t1, t2 = data[0]['ns'], data[-1]['ns'] + 1
+    offsets = {}
+    for (w1, w2, dataset) in iter_columns(swimlane, max_sensor, t1, t2, args.read_window):
+        for sensor, values in dataset.items():
+            no = int(sensor)
+            d = body[no]
+            label = country_label(d)
+            assert label == labels[sensor]
+            i = offsets.get(sensor, 0)
+            for record in values:
+                assert data[i][sensor] == record["value"], (data[i][sensor], record["value"])
+                i += 1
+            offsets[sensor] = i
+        if args.verbose:
+            print("read window [%s, %s): %d sensors" % (time_bound(w1), time_bound(w2), len(dataset)))
 
     return True
 
@@ -142,6 +152,8 @@ def main(args):
             r = validate(args, creds)
         elif args.info:
             r = print_info(args, creds)
+        elif args.export:
+            r = export(args, creds)
         else:
             key = str(args.test)
             if key in creds:
@@ -167,6 +179,10 @@ if __name__ == "__main__":
     parser.add_argument('-v','--validate', help='Validate data', required=False, action='store_true')
     parser.add_argument('-d','--delete', help='Clean data', required=False, action='store_true')
     parser.add_argument('-i','--info', help='Print info about test scenario/swimlane', required=False, action='store_true')
+    parser.add_argument('-x','--export', help='Export data to the given file', required=False)
+    parser.add_argument('--export_format', help='Export file format', required=False, choices=EXPORT_FORMATS, default='parquet')
+    parser.add_argument('--export_from', help='Export data from the given date (YYYY-MM-DD)', required=False, default='2020-01-01')
+    parser.add_argument('--export_to', help='Export data till the given date (YYYY-MM-DD), by default till now', required=False)
     parser.add_argument('--read_back', help='Validate write by read back', required=False, action='store_true', default=False)
     parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
     parser.add_argument('--creds', help="file with credential info", required=False)
@@ -175,6 +191,8 @@ if __name__ == "__main__":
     parser.add_argument('--model_p', type=int, choices=range(1, 8), help="AR model order", required=False, default=5)
     parser.add_argument('--model_q', type=int, choices=range(1, 6), help="MA model order", required=False, default=3)
     parser.add_argument('--model_n', type=int, help="forecast number", required=False, default=20)
+    parser.add_argument('--read_window', type=int, help="read back in time windows of the given number of seconds",
+                        required=False, default=100 * 86400)
 
     args = parser.parse_args()
 
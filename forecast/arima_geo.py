@@ -8,6 +8,7 @@ import argparse, os, sys, csv, json, time
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 import arima, utils
 from utils import ConnectionError, create_clients, open_creds, print_info, clean
+from columnar import export_dataset, EXPORT_FORMATS
 
 CREDS = 'arima_geo.json'
 CSV = 'covid_time_series.csv'
@@ -76,12 +77,12 @@ def read(args, creds):
             [-166.67, -69.31, 138.2781, 84.2812]
         ]
         for p in bbox:
-            read_tiles(args, swimlane, p)
+            read_tiles(args, swimlane, p, labels)
 
     print("OK: Data are read, scenario: %d, elapsed: %ss" % (args.query, round((time.time() - ms0) * 1000) / 1000.0))
 
 
-def read_tiles(args, swimlane, bbox):
+def read_tiles(args, swimlane, bbox, labels = {}):
     [lat1, lng1, lat2, lng2] = bbox
     q = "select sum($w) geo box [%s, %s, %s, %s] group $all by time as w format json (array: true) end." % (
         lng1, lat1, lng2, lat2
@@ -92,6 +93,11 @@ def read_tiles(args, swimlane, bbox):
     assert ok == 'ok' and 'data' in r and 'values' in r['data'][0], (ok, r)
     dataset = r['data'][0]['values']
 
+    if args.export:
+        path = tile_path(args.export, bbox)
+        total = export_dataset(dataset, path, args.export_format, labels)
+        print("exported %d rows to %s" % (total, path))
+
     if args.verbose:
         r['data'][0]['values'] = {}
         print("Server read details:")
@@ -103,6 +109,10 @@ def read_tiles(args, swimlane, bbox):
 
     return True
 
+def tile_path(path, bbox):
+    (base, ext) = os.path.splitext(path)
+    return "%s_%s%s" % (base, '_'.join([str(x) for x in bbox]), ext)
+
 #############################################################################
 
 def main(args):
@@ -141,7 +151,11 @@ if __name__ == "__main__":
     parser.add_argument('-d','--delete', help='Clean data', required=False, action='store_true')
     parser.add_argument('-i','--info', help='Print info about test scenario/swimlane', required=False, action='store_true')
     parser.add_argument("-q", "--query", type=int, choices=range(1, 11), help="Read scenario: 1 - read, 2 - model", required=False, default=1)
+    parser.add_argument('--export', help='Export tiles read by the query 2 to files named after the given file', required=False)
+    parser.add_argument('--export_format', help='Export file format', required=False, choices=EXPORT_FORMATS, default='parquet')
     parser.add_argument('--read_back', help='Validate write by read back', required=False, action='store_true', default=False)
+    parser.add_argument('--read_window', type=int, help="read back in time windows of the given number of seconds",
+                        required=False, default=100 * 86400)
     parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
     parser.add_argument('--creds', help="file with credential info", required=False)
     parser.add_argument('--csv', help="CSV file with timeseries to import", required=False)
@@ -135,6 +135,8 @@ if __name__ == "__main__":
     parser.add_argument('-i','--info', help='Print info about test scenario/swimlane', required=False, action='store_true')
     parser.add_argument("-q", "--query", type=int, choices=range(1, 11), help="Read scenario: 1 - read, 2 - model", required=False, default=1)
     parser.add_argument('--read_back', help='Validate write by read back', required=False, action='store_true', default=False)
+    parser.add_argument('--read_window', type=int, help="read back in time windows of the given number of seconds",
+                        required=False, default=100 * 86400)
     parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
     parser.add_argument('--creds', help="file with credential info", required=False)
     parser.add_argument('--csv', help="CSV file with timeseries to import", required=False)
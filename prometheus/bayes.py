@@ -5,36 +5,43 @@
 #
 
 from __future__ import print_function
-import argparse, os, sys, json, random, time
+import argparse, os, sys, json, random, time, threading
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 
 from mdtsdb import Mdtsdb
 import utils
-from utils import (new_user, ConnectionError, create_clients, update_clients, open_creds, HOST, PORT, REQ_TIMEOUT, ISHTTPS)
+from utils import (new_user, ConnectionError, create_clients, update_clients, open_creds, HOST, PORT, REQ_TIMEOUT, ISHTTPS,
+    client_pool, imap_concurrently)
+import bayes_model, bayes_cluster, inspect_prom, task_deploy
 
 CREDS = 'prom.json'
 
-BAYES_MODEL_FILE = 'bayes_model.txt'
-with open(os.path.join(os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__))), BAYES_MODEL_FILE), 'r') as fd:
-    BAYES_MODEL = fd.read()
-
-TASK_BODY = """
-%%-------------------------------------------------------------------
-%% Model:
-BayesModel = """ + BAYES_MODEL + """
+# --inference sample: the model inlined in the task is evaluated by sampling
+# for every state
+MODEL_HEADER = """%% Model:
+BayesModel = %(model)s.
 
 %% Bayesian network nodes graph
-Graph = #{
-    0: [1, 2, 3, 4],
-    1: [5, 6],
-    2: [5, 6],
-    3: [5, 6],
-    4: [5, 6]
-},
+Graph = %(graph)s,
 
 %% Nodes max values [0..Max):
-Upper = [2, 3, 5, 5, 5, 2, 2].
+Upper = %(upper)s."""
+RISKS_SAMPLE = "extract_prob(bayes_evaluate_model(Graph, Upper, BayesModel, %s, 5000))"
+
+# --inference table: risks of all states are precomputed by exact inference,
+# inlined in the task and looked up
+TABLE_HEADER = """%% Risks {Pcrash, Pddos, Poverload} of every state within Upper, by risk_key(state):
+RiskTable = %(table)s.
+
+fun risk_key(#{1 := Ping, 2 := Cpu, 3 := Mem, 4 := Reject}) ->
+    ((Ping * %(cpu)d + Cpu) * %(mem)d + Mem) * %(reject)d + Reject."""
+RISKS_TABLE = "maps::get(risk_key(%s), RiskTable)"
+
+# the header and the risks expressions are filled in by model_params()
+TASK_BODY = """
+%%-------------------------------------------------------------------
+%(model)s
 
 %%-------------------------------------------------------------------
 
@@ -129,7 +136,7 @@ task "observe_mdtsdb_nodes" (
                     round(avg(scaled))
                 end, series),
                 %% map risk type to current event probability
-                p_now = bayes_evaluate_model(Graph, Upper, BayesModel, bayes_state, 5000),
+                p_now = %(risks_now)s,
                 %% prediction (+1 minute) of an instance state
                 t_predict = t_now + 60,
                 bayes_state_prediction = maps::map(def (metric_no, points) ->
@@ -138,8 +145,8 @@ task "observe_mdtsdb_nodes" (
                     round(scale(metric_no, value_predict))
                 end, series),
                 %% map risk type to future event probability
-                p_future = bayes_evaluate_model(Graph, Upper, BayesModel, bayes_state_prediction, 5000),
-                {t_now, extract_prob(p_now), t_predict, extract_prob(p_future)};
+                p_future = %(risks_future)s,
+                {t_now, p_now, t_predict, p_future};
             n > 0 ->
                 'null';
             true ->
@@ -293,85 +300,304 @@ METRIC_CPU    = "mdtsdb_cpu_rel"
 METRIC_MEM    = "mdtsdb_mem_db_node_rel"
 METRIC_REJECT = "mdtsdb_gen_reject"
 
+# metric no in classify() of TASK_BODY -> metric
+METRICS = [(1, METRIC_PING), (2, METRIC_CPU), (3, METRIC_MEM), (4, METRIC_REJECT)]
+
 METRIC_NODE_EVAL_STATUS = "mdtsdb_node_eval_status"
 METRIC_CLUSTER_EVAL_STATUS = "mdtsdb_cluster_eval_status"
 
+TASKS = ["observe_mdtsdb_nodes", "observe_mdtsdb_cluster"]
+
 #############################################################################
 
 
-def ensure_source_swimlane(user, metric):
-    (ok, sw) = user.query("""tags_to_swimlane(#{"__name__": "%s"}).""" % metric)
-    assert ok == 'ok', (ok, sw)
-    (ok, opts) = user.query("""get_swimlane_opts("%s").""" % sw)
-    assert ok == 'ok', (ok, opts)
-    return (sw, opts["labels"])
+# swimlanes of the tasks: "source" ones are looked up, "report" ones are created
+DISCOVERY = [
+    (METRIC_NODE_EVAL_STATUS, "report"),
+    (METRIC_CLUSTER_EVAL_STATUS, "report"),
+    (METRIC_PING, "source"),
+    (METRIC_MEM, "source"),
+    (METRIC_CPU, "source"),
+    (METRIC_REJECT, "source")
+]
+# swimlane keys by server and user; sensor counts change and are always read
+SWIMLANES_CACHE = os.path.join(bayes_model.CACHE_DIR, 'bayes_swimlanes.json')
+SWIMLANES_LOCK = threading.Lock()
 
 
-def ensure_report_swimlane(user, metric):
-    (ok, sw) = user.query("""create_prom_swimlane(#{"__name__": "%s"}).""" % metric)
-    assert ok == 'ok', (ok, sw)
-    (ok, opts) = user.query("""get_swimlane_opts("%s").""" % sw)
-    assert ok == 'ok', (ok, opts)
-    return (sw, opts["labels"])
+def swimlanes_cache_key(user):
+    return "%s:%s/%s" % (utils.HOST, utils.PORT, user.admin_key)
 
 
-def config_swimlane(user, task_body, params):
-    (ok, r) = user.query("""get_task("observe_mem").""")
-    assert ok == 'ok', (ok, r)
-    if isinstance(r, dict):
-        print("User Task already exists:\n%s" % json.dumps(r, indent=4))
+def load_swimlanes_cache(path):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_swimlanes_cache(path, user, found):
+    with SWIMLANES_LOCK:
+        cache = load_swimlanes_cache(path)
+        cache[swimlanes_cache_key(user)] = found
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + ".tmp", 'w') as fd:
+                json.dump(cache, fd, indent=4, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except (IOError, OSError):
+            pass
+
+
+def swimlane_sensors(client, sw):
+    # as print_info of prom.py: the larger of the number of labels and the
+    # utilized sensors; the labels are counted on the server if it can
+    (ok, r) = client.query("""get_report("describe_swimlane", #{"key" => "%s"}).""" % sw)
+    if ok != 'ok' or not isinstance(r, dict) or "utilized_sensors" not in r:
+        return None
+    (ok, n) = client.query("""maps::size(maps::get("labels", get_swimlane_opts("%s"))).""" % sw)
+    if ok != 'ok' or isinstance(n, bool) or not isinstance(n, int):
+        (ok, opts) = client.query("""get_swimlane_opts("%s").""" % sw)
+        assert ok == 'ok', (ok, opts)
+        n = len(opts["labels"])
+    return max(n, r["utilized_sensors"])
+
+
+def discover_swimlanes(user, cache_path = SWIMLANES_CACHE, create = True):
+    # metric -> (swimlane or None, number of sensors) of DISCOVERY, resolved concurrently;
+    # without create (dry runs), missing report swimlanes are not created and
+    # the cache is not written
+    known = load_swimlanes_cache(cache_path).get(swimlanes_cache_key(user), {}) if cache_path else {}
+    get_client = client_pool(user)
+    def resolve(item):
+        (metric, kind) = item
+        client = get_client()
+        if metric in known:
+            sensors = swimlane_sensors(client, known[metric])
+            if sensors is not None:
+                return (metric, known[metric], sensors)
+        if kind == "report" and create:
+            (ok, sw) = client.query("""create_prom_swimlane(#{"__name__": "%s"}).""" % metric)
+        else:
+            (ok, sw) = client.query("""tags_to_swimlane(#{"__name__": "%s"}).""" % metric)
+        assert ok == 'ok', (ok, sw)
+        if not isinstance(sw, str):
+            return (metric, None, 0)
+        sensors = swimlane_sensors(client, sw)
+        assert sensors is not None, ("describe_swimlane", sw)
+        return (metric, sw, sensors)
+    found = dict([(metric, (sw, sensors)) for (metric, sw, sensors) in imap_concurrently(resolve, DISCOVERY, len(DISCOVERY))])
+    swimlanes = dict([(metric, sw) for metric, (sw, _) in found.items() if sw is not None])
+    if cache_path and create and swimlanes != known:
+        save_swimlanes_cache(cache_path, user, swimlanes)
+    return found
+
+
+def forget_swimlanes(user, cache_path = SWIMLANES_CACHE):
+    if cache_path:
+        with SWIMLANES_LOCK:
+            cache = load_swimlanes_cache(cache_path)
+        if swimlanes_cache_key(user) in cache:
+            save_swimlanes_cache(cache_path, user, {})
+
+
+# model digest -> risk table text, computed once for deploys to many users
+RISK_TABLES = {}
+
+def model_params(args):
+    # a dry run parses the model without writing the model cache
+    model = bayes_model.load(args.model, None if args.dry_run else (args.model_cache or None), args.verbose)
+    if args.inference == 'table':
+        if model.digest not in RISK_TABLES:
+            RISK_TABLES[model.digest] = bayes_model.risk_table_text(bayes_model.risk_table(model))
+        table = RISK_TABLES[model.digest]
+        (cpu, mem, reject) = [bayes_model.UPPER[node] for node in bayes_model.EVIDENCE[1:]]
+        header = TABLE_HEADER % {"table": table, "cpu": cpu, "mem": mem, "reject": reject}
+        risks = RISKS_TABLE
     else:
-        task_body = task_body % params
-        print("%s" % task_body)
-        (ok, r) = user.query(task_body)
-        assert ok == 'ok', (ok, r)
+        header = MODEL_HEADER % {
+            "model": model.text(),
+            "graph": bayes_model.graph_text(),
+            "upper": bayes_model.upper_text()
+        }
+        risks = RISKS_SAMPLE
+    return {
+        "model": header,
+        "risks_now": risks % "bayes_state",
+        "risks_future": risks % "bayes_state_prediction"
+    }
+
+
+def task_units(args, user, log = print):
+    # the rendered task script, or None if the source metrics are missing;
+    # nothing is created on the server or written to the local caches with --dry_run
+    found = discover_swimlanes(user, args.swimlane_cache or None, not args.dry_run)
+    (report_sw, _) = found[METRIC_NODE_EVAL_STATUS]
+    log("touch node report swimlane: %s" % report_sw)
+    (cluster_report_sw, _) = found[METRIC_CLUSTER_EVAL_STATUS]
+    log("touch cluster report swimlane: %s" % cluster_report_sw)
+
+    (ping_sw, ping_sensors) = found[METRIC_PING]
+    log("found ping swimlane: %s: %d sensors" % (ping_sw, ping_sensors))
+    (mem_sw, mem_sensors) = found[METRIC_MEM]
+    log("found mem swimlane: %s: %d sensors" % (mem_sw, mem_sensors))
+    (cpu_sw, cpu_sensors) = found[METRIC_CPU]
+    log("found cpu swimlane: %s: %d sensors" % (cpu_sw, cpu_sensors))
+    (rj_sw, rj_sensors) = found[METRIC_REJECT]
+    log("found reject swimlane: %s: %d sensors" % (rj_sw, rj_sensors))
+
+    if mem_sensors > 0 and cpu_sensors > 0 and ping_sensors > 0 and rj_sensors > 0:
+        data_source = """["%s".$0-$%d, "%s".$0-$%d, "%s".$0-$%d, "%s".$0-$%d]""" % (
+            ping_sw, ping_sensors - 1,
+            mem_sw, mem_sensors - 1,
+            cpu_sw, cpu_sensors - 1,
+            rj_sw, rj_sensors - 1
+        )
+        params = {
+            "from": data_source,
+            "ping": ping_sw,
+            "cpu": cpu_sw,
+            "mem": mem_sw,
+            "reject": rj_sw,
+            "report_swimlane": report_sw,
+            "cluster_report_swimlane": cluster_report_sw,
+            "node_metric": METRIC_NODE_EVAL_STATUS,
+            "cluster_metric": METRIC_CLUSTER_EVAL_STATUS
+        }
+        params.update(model_params(args))
+        return {"bayes": TASK_BODY % params}
+    return None
 
 
 def create(args, creds):
+    if args.all:
+        return create_all(args, creds)
     r = create_clients(args.test, creds)
     if r is not None:
         (user, _, attrs) = r
         print(json.dumps(attrs, indent=4))
-
-        (report_sw, report_labels) = ensure_report_swimlane(user, METRIC_NODE_EVAL_STATUS)
-        print("touch node report swimlane: %s: %s" % (report_sw, report_labels))
-        (cluster_report_sw, cluster_report_labels) = ensure_report_swimlane(user, METRIC_CLUSTER_EVAL_STATUS)
-        print("touch cluster report swimlane: %s: %s" % (cluster_report_sw, cluster_report_labels))
-
-        (ping_sw, ping_labels) = ensure_source_swimlane(user, METRIC_PING)
-        print("found ping swimlane: %s: %s" % (ping_sw, ping_labels))
-        (mem_sw, mem_labels) = ensure_source_swimlane(user, METRIC_MEM)
-        print("found mem swimlane: %s: %s" % (mem_sw, mem_labels))
-        (cpu_sw, cpu_labels) = ensure_source_swimlane(user, METRIC_CPU)
-        print("found cpu swimlane: %s: %s" % (cpu_sw, cpu_labels))
-        (rj_sw, rj_labels) = ensure_source_swimlane(user, METRIC_REJECT)
-        print("found reject swimlane: %s: %s" % (rj_sw, rj_labels))
-
-        if len(mem_labels) > 0 and len(cpu_labels) > 0 and len(ping_labels) > 0 and len(rj_labels) > 0:
-            data_source = """["%s".$0-$%d, "%s".$0-$%d, "%s".$0-$%d, "%s".$0-$%d]""" % (
-                ping_sw, len(ping_labels) - 1,
-                mem_sw, len(mem_labels) - 1,
-                cpu_sw, len(cpu_labels) - 1,
-                rj_sw, len(rj_labels) - 1
-            )
-            params = {
-                "from": data_source,
-                "ping": ping_sw,
-                "cpu": cpu_sw,
-                "mem": mem_sw,
-                "reject": rj_sw,
-                "report_swimlane": report_sw,
-                "cluster_report_swimlane": cluster_report_sw,
-                "node_metric": METRIC_NODE_EVAL_STATUS,
-                "cluster_metric": METRIC_CLUSTER_EVAL_STATUS
-            }
-            config_swimlane(user, TASK_BODY, params)
+        units = task_units(args, user)
+        if units is not None:
+            actions = task_deploy.deploy(user, units, TASKS, args.dry_run, True)
+            print("tasks: %s" % ", ".join(["%s %d" % kv for kv in sorted(actions.items())]))
         else:
             print("miss ping/memory/cpu/reject metrics: %d" % args.test)
     else:
         print("unknown test scenario: %d" % args.test)
 
 
+def create_all(args, creds):
+    # deploys the tasks to every test scenario of the creds file concurrently
+    def render(user):
+        units = task_units(args, user, lambda s: None)
+        assert units is not None, "miss ping/memory/cpu/reject metrics"
+        return units
+    targets = [(key, create_clients(int(key), creds)[0]) for key in sorted(creds) if key.isdigit()]
+    return task_deploy.report(task_deploy.deploy_all(targets, render, TASKS, args.deploy_workers, args.dry_run, args.verbose))
+
+
+def parse_states(texts):
+    # "ping,cpu,mem,reject" scaled values, or "all" for all states within Upper
+    states = []
+    for text in texts:
+        if text == "all":
+            states.extend(bayes_model.evidence_states())
+        else:
+            values = [int(v) for v in text.split(',')]
+            if len(values) != len(bayes_model.EVIDENCE) or any([
+                    not 0 <= v < bayes_model.UPPER[node] for (node, v) in zip(bayes_model.EVIDENCE, values)]):
+                raise ValueError("bad state: %s (Upper: %s)" % (text, bayes_model.UPPER))
+            states.append(dict(zip(bayes_model.EVIDENCE, values)))
+    return states
+
+
+def evaluate(args):
+    # local inference: exact, and with --samples also likelihood weighting as on the server
+    model = bayes_model.load(args.model, args.model_cache or None, args.verbose)
+    states = parse_states(args.evaluate)
+    t = time.time()
+    exact = [bayes_model.risks(model.posteriors(state)) for state in states]
+    exact_s = time.time() - t
+    sampled = None
+    if args.samples > 0:
+        t = time.time()
+        lw = model.likelihood_weighting(states, args.samples)
+        sampled = list(zip(*[lw[node][:, 1].tolist() for node in (bayes_model.CRASH, bayes_model.DDOS, bayes_model.OVERLOAD)]))
+        sampled_s = time.time() - t
+    for i, state in enumerate(states):
+        d = {"state": [state[node] for node in bayes_model.EVIDENCE], "exact": exact[i]}
+        if sampled:
+            d["sampled"] = sampled[i]
+        print(json.dumps(d))
+    print("states: %d, exact: %.3fs" % (len(states), exact_s), file=sys.stderr)
+    if sampled:
+        error = max([abs(a - b) for (e, s) in zip(exact, sampled) for (a, b) in zip(e, s)])
+        print("likelihood weighting (%d samples): %.3fs, max abs error: %.4f" % (args.samples, sampled_s, error), file=sys.stderr)
+
+
+def replay(args, creds):
+    # risks of every instance for every step of the last --replay seconds from stored metrics
+    # (the state is the scaled last value of each metric in the step)
+    r = create_clients(args.test, creds)
+    if r is None:
+        print("unknown test scenario: %d" % args.test)
+        return
+    (user, _, attrs) = r
+    model = bayes_model.load(args.model, args.model_cache or None, args.verbose)
+    t2 = int(time.time())
+    t1 = t2 - args.replay
+    selectors = [("__name__", metric, "EQ") for (_, metric) in METRICS]
+    metric_no = dict([(metric, no) for (no, metric) in METRICS])
+    points = {}
+    for (selector, _, _, labels, samples) in inspect_prom.iter_selected(
+            user, selectors, t1, t2, args.chunk, args.workers, args.replay_step, 'last', args.verbose):
+        instance = labels.get("instance", labels.get("__name__"))
+        for (t_ms, value) in samples:
+            points.setdefault((t_ms // 1000, instance), {})[metric_no[selector[1]]] = value
+    risks = {}
+    for ((t, instance), values) in sorted(points.items()):
+        if len(values) < len(METRICS):
+            continue
+        state = tuple([bayes_model.scale(no, values[no]) for no in bayes_model.EVIDENCE])
+        if state not in risks:
+            risks[state] = bayes_model.risks(model.posteriors(dict(zip(bayes_model.EVIDENCE, state))))
+        (p_crash, p_ddos, p_overload) = risks[state]
+        print(json.dumps({"t": t, "instance": instance, "state": state,
+                          "crash": p_crash, "ddos": p_ddos, "overload": p_overload}))
+
+
+def cluster_replay(args, creds):
+    # the report of observe_mdtsdb_cluster for every --cluster_window of the last --cluster_replay
+    # seconds from stored node risks, with the given DBSCAN r/n and attack broadness threshold
+    r = create_clients(args.test, creds)
+    if r is None:
+        print("unknown test scenario: %d" % args.test)
+        return
+    (user, _, attrs) = r
+    t2 = int(time.time())
+    t1 = t2 - args.cluster_replay
+    t1 -= t1 % args.cluster_window
+    selector = ("__name__", METRIC_NODE_EVAL_STATUS, "EQ")
+    t = time.time()
+    rows = [(labels, samples) for (_, _, _, labels, samples) in inspect_prom.iter_selected(
+        user, [selector], t1, t2, args.chunk, args.workers, 0, 'last', args.verbose)]
+    read_s = time.time() - t
+    t = time.time()
+    alerts = 0
+    windows = bayes_cluster.window_risks(rows, args.cluster_window)
+    for (w, risks) in sorted(windows.items()):
+        d = bayes_cluster.report(risks, args.cluster_r, args.cluster_n, args.broadness)
+        alerts += d["alert"]
+        if not args.verbose:
+            for name in ("overloaded", "ddos", "both"):
+                d[name] = len(d[name])
+        print(json.dumps(dict(d, t=w)))
+    print("windows: %d, alerts: %d, read: %.1fs, clustering: %.1fs (r: %s, n: %d, broadness: %s)" % (
+        len(windows), alerts, read_s, time.time() - t, args.cluster_r, args.cluster_n, args.broadness), file=sys.stderr)
+
+
 def clean(args, creds):
     key = str(args.test)
     if key in creds:
@@ -383,6 +609,7 @@ def clean(args, creds):
 
         (ok, r) = user.query("""delete_swimlane(tags_to_swimlane(#{"__name__": "%s"})).""" % METRIC_CLUSTER_EVAL_STATUS)
         print("delete swimlane of the metric %s: %s" % (METRIC_CLUSTER_EVAL_STATUS, ok))
+        forget_swimlanes(user, args.swimlane_cache or None)
 
         (ok, tasks) = user.query("user_tasks().")
         assert ok == 'ok', (ok, tasks)
@@ -482,7 +709,13 @@ def main(args):
     r = None
     try:
         creds = open_creds(args, CREDS)
-        if args.create:
+        if args.evaluate:
+            r = evaluate(args)
+        elif args.replay:
+            r = replay(args, creds)
+        elif args.cluster_replay:
+            r = cluster_replay(args, creds)
+        elif args.create:
             r = create(args, creds)
         elif args.env:
             r = update_env(args, creds)
@@ -510,15 +743,35 @@ if __name__ == "__main__":
     parser.add_argument('--secret', help='TimeEngine User secret', required=False)
     parser.add_argument('-t', '--test', type=int, choices=range(1, 11), help='test scenario number', default=1)
     parser.add_argument('-c','--create', help='Create Prometheus User', required=False, action='store_true')
+    parser.add_argument('--swimlane_cache', help="File of discovered swimlanes ('' - no cache)", required=False, default=SWIMLANES_CACHE)
+    parser.add_argument('--all', help='Deploy the tasks to all test scenarios of the creds file (with -c)', required=False, action='store_true')
+    parser.add_argument('--deploy_workers', type=int, help="Number of concurrent deploys with --all", required=False, default=8)
+    parser.add_argument('--dry_run', help='Only print what a deploy would change', required=False, action='store_true')
     parser.add_argument('-q', '--query', type=int, choices=range(1, 11), help="""Read scenario""", required=False, default=1)
     parser.add_argument('-d','--delete', help='Clean data', required=False, action='store_true')
     parser.add_argument('-i','--info', help='Print info about test scenario/swimlane', required=False, action='store_true')
     parser.add_argument('-e','--env', help='Update User environment', required=False, action='store_true')
     parser.add_argument('-n', '--num', type=int, help="""Number of data points to write""", required=False, default=100)
     parser.add_argument('--filter', type=int, choices=range(0, 3), help="Generate data for filtering", required=False, default=1)
+    parser.add_argument('--model', help="Bayesian model file", required=False, default=bayes_model.MODEL_FILE)
+    parser.add_argument('--model_cache', help="Directory of parsed models ('' - no cache)", required=False, default=bayes_model.CACHE_DIR)
+    parser.add_argument('--inference', help="""How the task gets risks of a state: 'table' - a lookup in the
+        table precomputed for all states, 'sample' - sampling of the model""", required=False, choices=['table', 'sample'], default='table')
+    parser.add_argument('--evaluate', action='append', help="""Evaluate the model locally for a state "ping,cpu,mem,reject"
+        of scaled values, or "all" states; can be repeated""", required=False)
+    parser.add_argument('--samples', type=int, help="Also evaluate with likelihood weighting of the given number of samples", required=False, default=0)
+    parser.add_argument('--replay', type=int, help="Evaluate the model locally for stored metrics of the given number of seconds from now back", required=False)
+    parser.add_argument('--replay_step', type=int, help="Replay step in seconds", required=False, default=60)
+    parser.add_argument('--cluster_replay', type=int, help="""Compute the cluster report locally from stored node risks
+        of the given number of seconds from now back""", required=False)
+    parser.add_argument('--cluster_window', type=int, help="Cluster report window in seconds", required=False, default=60)
+    parser.add_argument('--cluster_r', type=float, help="DBSCAN radius", required=False, default=bayes_cluster.R)
+    parser.add_argument('--cluster_n', type=int, help="DBSCAN min points", required=False, default=bayes_cluster.N)
+    parser.add_argument('--broadness', type=float, help="Attack broadness threshold of a cluster report", required=False, default=bayes_cluster.BROADNESS)
+    parser.add_argument('--chunk', type=int, help="Read metrics in chunks of the given number of seconds", required=False, default=3600)
+    parser.add_argument('--workers', type=int, help="Number of concurrent chunk reads", required=False, default=4)
     parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
     parser.add_argument('--creds', help="file with credential info", required=False)
-    parser.add_argument('--user', help="Prometheus User", required=False, default="MyPromUser")
     parser.add_argument('--su_key', help="Prometheus SU Key", required=False, default="MyPromOwnerUser")
     parser.add_argument('--su_secret', help="Prometheus SU Secret", required=False, default="MyPromOwnerSecret")
 
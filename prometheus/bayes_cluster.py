@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+#
+# bayes_cluster.py - the cluster report of observe_mdtsdb_cluster, computed locally
+#
+# report() does what the task's result function does for one window: the
+# (DDoS, Overload) "now" risks of every instance (max in the window), the
+# overloaded/ddos/both classes, the attack broadness and, above the threshold,
+# DBSCAN clusters of the risks with their centroids.
+#
+# dbscan() is exact DBSCAN (Euclidean, a point is a core point if at least n
+# points, itself included, are within r) over a grid of cells of side r/sqrt(2):
+# equal points are merged (risks come from a table of a few hundred states),
+# all points of a cell are within r of each other, so a cell of at least n
+# points is all core points, and only the 5x5 neighbouring cells are searched.
+# Labels are 0 for noise and 1, 2, ... for clusters in order of appearance.
+#
+
+from __future__ import print_function
+import math, collections
+
+R = 0.2
+N = 3
+BROADNESS = 0.1
+RISK_LOW = 0.3
+
+# cells that may have points within r of a cell of side r/sqrt(2)
+NEIGHBOURS = [(dx, dy) for dx in range(-2, 3) for dy in range(-2, 3)]
+
+#############################################################################
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def dbscan(points, r = R, n = N):
+    # points: [(x, y)] -> [label]
+    import numpy
+    if not points:
+        return []
+    (unique, inverse, counts) = numpy.unique(numpy.asarray(points, dtype=numpy.float64), axis=0,
+                                              return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    side = r / math.sqrt(2)
+    cells = collections.defaultdict(list)
+    for (i, c) in enumerate(map(tuple, numpy.floor(unique / side).astype(numpy.int64).tolist())):
+        cells[c].append(i)
+    cells = dict([(c, numpy.array(ix)) for c, ix in cells.items()])
+    r2 = r * r
+
+    def near(c):
+        return [cells[(c[0] + dx, c[1] + dy)] for (dx, dy) in NEIGHBOURS if (c[0] + dx, c[1] + dy) in cells]
+
+    def within(a, b):
+        # (len(a), len(b)) mask of pairs within r
+        d = unique[a][:, None, :] - unique[b][None, :, :]
+        return (d * d).sum(axis=2) <= r2
+
+    def near_cell(a, c):
+        # points of a within r of the cell c
+        lo = numpy.array(c, dtype=numpy.float64) * side
+        d = numpy.maximum(numpy.maximum(lo - unique[a], unique[a] - (lo + side)), 0.0)
+        return a[(d * d).sum(axis=1) <= r2]
+
+    def any_within(a, b):
+        # in blocks of about a million pairs: dense cells have many points
+        if len(a) == 0 or len(b) == 0:
+            return False
+        block = max(1, (1 << 20) // len(b))
+        for i in range(0, len(a), block):
+            if within(a[i:i + block], b).any():
+                return True
+        return False
+
+    # core points
+    core = numpy.zeros(len(unique), dtype=bool)
+    for c, ix in cells.items():
+        if counts[ix].sum() >= n:
+            core[ix] = True
+        else:
+            others = numpy.concatenate(near(c))
+            core[ix] = (within(ix, others) * counts[others][None, :]).sum(axis=1) >= n
+
+    # clusters: connected core cells
+    core_cells = dict([(c, ix[core[ix]]) for c, ix in cells.items() if core[ix].any()])
+    keys = sorted(core_cells)
+    index = dict([(c, i) for (i, c) in enumerate(keys)])
+    parent = list(range(len(keys)))
+    for c in keys:
+        for (dx, dy) in NEIGHBOURS:
+            o = (c[0] + dx, c[1] + dy)
+            if o in core_cells and index[o] > index[c] and find(parent, index[o]) != find(parent, index[c]):
+                if any_within(near_cell(core_cells[c], o), near_cell(core_cells[o], c)):
+                    parent[find(parent, index[o])] = find(parent, index[c])
+
+    # unique point -> component (-1 - noise); border points join the nearest core point
+    component = numpy.full(len(unique), -1, dtype=numpy.int64)
+    for c, ix in core_cells.items():
+        component[ix] = find(parent, index[c])
+    for c, ix in cells.items():
+        border = ix[~core[ix]]
+        if len(border) == 0:
+            continue
+        others = [o[core[o]] for o in near(c)]
+        others = numpy.concatenate(others) if others else numpy.array([], dtype=numpy.int64)
+        if len(others) == 0:
+            continue
+        d = unique[border][:, None, :] - unique[others][None, :, :]
+        d = (d * d).sum(axis=2)
+        nearest = d.argmin(axis=1)
+        ok = d[numpy.arange(len(border)), nearest] <= r2
+        component[border[ok]] = component[others[nearest[ok]]]
+
+    # labels in order of appearance
+    labels, numbers = [], {}
+    for k in component[inverse].tolist():
+        if k < 0:
+            labels.append(0)
+        else:
+            labels.append(numbers.setdefault(k, 1 + len(numbers)))
+    return labels
+
+def centroids(series, labels):
+    # as classify(): [(size, "(mean DDoS, mean Overload)")] of clusters sorted by size
+    clusters = {}
+    for (label, (ddos, overload)) in zip(labels, series):
+        if label:
+            clusters.setdefault(label, []).append((ddos, overload))
+    out = [(len(ps), "(%.2f, %.2f)" % (sum([d for d, _ in ps]) / len(ps), sum([o for _, o in ps]) / len(ps)))
+           for ps in clusters.values()]
+    return sorted(out, key=lambda c: c[0])
+
+def report(risks, r = R, n = N, broadness = BROADNESS):
+    # risks: {instance: (max DDoS, max Overload)} of instances with both risks in a window
+    (overloaded, ddos, both) = ([], [], [])
+    for instance, (d, o) in sorted(risks.items()):
+        if d < RISK_LOW and o < RISK_LOW:
+            continue
+        if d < RISK_LOW:
+            overloaded.append(instance)
+        elif o < RISK_LOW:
+            ddos.append(instance)
+        else:
+            both.append(instance)
+    n_total = len(risks)
+    d = {"n_total": n_total, "n_threat": len(overloaded) + len(ddos) + len(both),
+         "overloaded": overloaded, "ddos": ddos, "both": both}
+    if d["n_threat"] == 0:
+        return dict(d, attack_broadness=0, alert=False)
+    d["attack_broadness"] = (len(ddos) + len(both)) / float(n_total)
+    d["alert"] = d["attack_broadness"] > broadness
+    if d["alert"]:
+        series = list(risks.values())
+        d["clusters"] = centroids(series, dbscan([(o, dd) for (dd, o) in series], r, n))
+    return d
+
+def window_risks(rows, window):
+    # (labels, [[t_ms, value]]) of node eval status series -> {window start: {instance: (DDoS, Overload)}}
+    windows = {}
+    for (labels, samples) in rows:
+        if labels.get("when") != "now" or labels.get("risk") not in ("ddos", "overload"):
+            continue
+        i = 0 if labels["risk"] == "ddos" else 1
+        instance = labels.get("instance")
+        for (t_ms, value) in samples:
+            w = windows.setdefault(t_ms // 1000 // window * window, {})
+            v = w.setdefault(instance, [-1, -1])
+            v[i] = max(v[i], value)
+    return dict([(t, dict([(k, tuple(v)) for k, v in w.items() if v[0] >= 0.0 and v[1] >= 0.0]))
+                 for t, w in windows.items()])
+
+#############################################################################
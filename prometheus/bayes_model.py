@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+#
+# bayes_model.py - the Bayesian network of bayes.py: parsing, validation, caching
+#
+# bayes_model.txt is a list of conditional probability tables (CPTs), one per
+# node in topological order of GRAPH (roots first, by node number); a CPT maps
+# "value,parent1,parent2,..." (parents in GRAPH order) to a probability.
+#
+# A parsed model keeps per node its parents, domain size and a flat table
+# indexed by (parent values as a mixed-radix number) * domain + value. Parsed
+# models are cached as JSON files named by the SHA-1 of the model text.
+# A malformed model is an error; CPT rows that do not sum to 1 are kept as
+# they are and reported as warnings.
+#
+# Inference runs locally: exact (enumeration of the non-evidence nodes, rows
+# are normalized) or likelihood weighting batched with NumPy over many states,
+# as the server's bayes_evaluate_model does per state.
+#
+
+from __future__ import print_function
+import os, json, hashlib, bisect, itertools
+
+MODEL_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bayes_model.txt')
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mdtsdb')
+
+# Bayesian network nodes graph: node -> parents
+GRAPH = {
+    0: [1, 2, 3, 4],
+    1: [5, 6],
+    2: [5, 6],
+    3: [5, 6],
+    4: [5, 6]
+}
+# Nodes max values [0..Max), for evidence nodes - the range of scaled metrics
+UPPER = [2, 3, 5, 5, 5, 2, 2]
+
+CRASH, DDOS, OVERLOAD = 0, 5, 6
+EVIDENCE = [1, 2, 3, 4]
+ROW_TOLERANCE = 0.01
+
+# the thresholds of scale() in bayes.TASK_BODY: metric no -> upper bounds of values 0, 1, ...
+SCALES = {
+    1: [50, 500],
+    2: [0.10, 0.25, 0.40, 0.55],
+    3: [0.1, 0.2, 0.3, 0.4],
+    4: [0.001, 0.01, 0.1, 0.5]
+}
+
+#############################################################################
+
+def topological_order(graph, n):
+    (order, done) = ([], set())
+    while len(order) < n:
+        ready = sorted([i for i in range(n) if i not in done and all([p in done for p in graph.get(i, [])])])
+        if not ready:
+            raise ValueError("the graph has a cycle")
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def parse(text):
+    # the model is an Erlang list of maps: [#{"k": v, ...}, ...].
+    return json.loads(text.strip().rstrip('.').replace('#{', '{'))
+
+def row_index(parent_values, parent_domains):
+    i = 0
+    for (v, d) in zip(parent_values, parent_domains):
+        i = i * d + v
+    return i
+
+def graph_text(graph = GRAPH):
+    return "#{\n%s\n}" % ",\n".join(["    %d: %s" % (node, json.dumps(ps)) for node, ps in sorted(graph.items())])
+
+def upper_text(upper = UPPER):
+    return json.dumps(upper)
+
+
+class BayesModel(object):
+    def __init__(self, digest, nodes, warnings = []):
+        # nodes: {node: {'parents': [...], 'domain': n, 'table': [p, ...]}}
+        self.digest = digest
+        self.nodes = nodes
+        self.warnings = warnings
+        self.order = topological_order(GRAPH, len(UPPER))
+
+    @classmethod
+    def from_cpts(cls, digest, cpts):
+        order = topological_order(GRAPH, len(UPPER))
+        if len(cpts) != len(order):
+            raise ValueError("model: %d CPTs for %d nodes" % (len(cpts), len(order)))
+        (nodes, warnings) = ({}, [])
+        for (node, cpt) in zip(order, cpts):
+            parents = GRAPH.get(node, [])
+            keys = [tuple([int(x) for x in k.split(',')]) for k in cpt]
+            if any([len(k) != 1 + len(parents) for k in keys]):
+                raise ValueError("model: node %d: keys are not 'value,%s'" % (node, ",".join(map(str, parents))))
+            domain = 1 + max([k[0] for k in keys])
+            if domain < UPPER[node]:
+                raise ValueError("model: node %d: %d values, Upper is %d" % (node, domain, UPPER[node]))
+            parent_domains = [nodes[p]['domain'] for p in parents]
+            rows = 1
+            for d in parent_domains:
+                rows *= d
+            table = [None] * (rows * domain)
+            for (k, (key, p)) in zip(keys, cpt.items()):
+                if any([v >= d for (v, d) in zip(k[1:], parent_domains)]):
+                    raise ValueError("model: node %d: parent value out of range: %s" % (node, key))
+                table[row_index(k[1:], parent_domains) * domain + k[0]] = float(p)
+            if None in table:
+                raise ValueError("model: node %d: %d of %d entries are missing" % (node, table.count(None), len(table)))
+            for r in range(rows):
+                total = sum(table[r * domain:(r + 1) * domain])
+                if abs(total - 1.0) > ROW_TOLERANCE:
+                    warnings.append("node %d: row %d sums to %s" % (node, r, round(total, 6)))
+            nodes[node] = {'parents': parents, 'domain': domain, 'table': table}
+        return cls(digest, nodes, warnings)
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d['digest'], dict([(int(node), v) for node, v in d['nodes'].items()]), d['warnings'])
+
+    def to_json(self):
+        return {'digest': self.digest, 'nodes': self.nodes, 'warnings': self.warnings}
+
+    def domain(self, node):
+        return self.nodes[node]['domain']
+
+    def p(self, node, value, parent_values):
+        n = self.nodes[node]
+        domains = [self.nodes[p]['domain'] for p in n['parents']]
+        return n['table'][row_index(parent_values, domains) * n['domain'] + value]
+
+    def row(self, node, parent_values):
+        # normalized distribution of the node given its parents
+        n = self.nodes[node]
+        domains = [self.nodes[p]['domain'] for p in n['parents']]
+        i = row_index(parent_values, domains) * n['domain']
+        values = n['table'][i:i + n['domain']]
+        total = sum(values)
+        return [v / total for v in values] if total > 0 else [1.0 / n['domain']] * n['domain']
+
+    def posteriors(self, evidence):
+        # evidence: {node: value} -> {node: [P(value) for value in domain]} of the other nodes (exact);
+        # for evidence of probability 0 the distributions are all zeros
+        hidden = [node for node in self.order if node not in evidence]
+        marginals = dict([(node, [0.0] * self.domain(node)) for node in hidden])
+        for values in itertools.product(*[range(self.domain(node)) for node in hidden]):
+            state = dict(evidence)
+            state.update(zip(hidden, values))
+            p = 1.0
+            for node in self.order:
+                p *= self.row(node, [state[q] for q in self.nodes[node]['parents']])[state[node]]
+                if p == 0.0:
+                    break
+            for (node, v) in zip(hidden, values):
+                marginals[node][v] += p
+        for node, m in marginals.items():
+            total = sum(m)
+            marginals[node] = [x / total for x in m] if total > 0 else m
+        return marginals
+
+    def likelihood_weighting(self, states, samples = 5000, seed = None):
+        # states: N evidence maps with the same nodes -> {node: array (N, domain)} of the other nodes
+        import numpy
+        rng = numpy.random.default_rng(seed)
+        evidence = sorted(states[0])
+        n = len(states)
+        values = dict([(node, numpy.repeat(numpy.array([s[node] for s in states], dtype=numpy.int64)[:, None], samples, axis=1))
+                       for node in evidence])
+        weights = numpy.ones((n, samples))
+        for node in self.order:
+            nd = self.nodes[node]
+            rows = numpy.zeros((n, samples), dtype=numpy.int64)
+            for p in nd['parents']:
+                rows = rows * self.domain(p) + values[p]
+            table = numpy.array(nd['table']).reshape(-1, nd['domain'])
+            table = table / numpy.maximum(table.sum(axis=1, keepdims=True), 1e-300)
+            dist = table[rows]
+            if node in evidence:
+                weights *= numpy.take_along_axis(dist, values[node][:, :, None], axis=2)[:, :, 0]
+            else:
+                u = rng.random((n, samples, 1))
+                values[node] = numpy.minimum((dist.cumsum(axis=2) < u).sum(axis=2), nd['domain'] - 1)
+        total = numpy.maximum(weights.sum(axis=1), 1e-300)
+        out = {}
+        for node in self.order:
+            if node not in evidence:
+                out[node] = numpy.stack([(weights * (values[node] == v)).sum(axis=1) / total
+                                         for v in range(self.domain(node))], axis=1)
+        return out
+
+    def text(self):
+        # the model in the server format, as parsed
+        cpts = []
+        for node in self.order:
+            n = self.nodes[node]
+            domains = [n['domain']] + [self.nodes[p]['domain'] for p in n['parents']]
+            keys = [[]]
+            for d in domains:
+                keys = [k + [v] for k in keys for v in range(d)]
+            items = ['"%s": %.12g' % (",".join(map(str, k)), self.p(node, k[0], k[1:])) for k in keys]
+            cpts.append("#{" + ", ".join(items) + "}")
+        return "[" + ", ".join(cpts) + "]"
+
+
+
+def scale(metric_no, value):
+    return bisect.bisect_left(SCALES[metric_no], value)
+
+def evidence_states():
+    # all states of the evidence nodes within Upper
+    return [dict(zip(EVIDENCE, values)) for values in itertools.product(*[range(UPPER[node]) for node in EVIDENCE])]
+
+def risks(posteriors):
+    # as extract_prob() in bayes.TASK_BODY: (Pcrash, Pddos, Poverload)
+    return tuple([float(posteriors[node][1]) for node in (CRASH, DDOS, OVERLOAD)])
+
+def state_key(state):
+    # as risk_key() in bayes.TABLE_HEADER
+    return row_index([state[node] for node in EVIDENCE], [UPPER[node] for node in EVIDENCE])
+
+def risk_table(model):
+    # state key -> (Pcrash, Pddos, Poverload) for all states within Upper (exact)
+    return dict([(state_key(state), risks(model.posteriors(state))) for state in evidence_states()])
+
+def risk_table_text(table):
+    return "#{" + ", ".join(["%d: {%s}" % (key, ", ".join([str(round(p, 6)) for p in table[key]])) for key in sorted(table)]) + "}"
+
+
+def load(path = MODEL_FILE, cache_dir = CACHE_DIR, verbose = False):
+    with open(path, 'r') as fd:
+        text = fd.read()
+    h = digest(text)
+    cache = os.path.join(cache_dir, "bayes_model_%s.json" % h) if cache_dir else None
+    if cache and os.path.isfile(cache):
+        try:
+            with open(cache) as fd:
+                model = BayesModel.from_json(json.load(fd))
+            if verbose:
+                print("bayes model %s: cached" % h[:12])
+                for w in model.warnings:
+                    print("bayes model warning: %s" % w)
+            return model
+        except (IOError, ValueError, KeyError):
+            pass
+    model = BayesModel.from_cpts(h, parse(text))
+    if cache:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache + ".tmp", 'w') as fd:
+                json.dump(model.to_json(), fd)
+            os.replace(cache + ".tmp", cache)
+        except (IOError, OSError):
+            pass
+    if verbose:
+        print("bayes model %s: parsed" % h[:12])
+        for w in model.warnings:
+            print("bayes model warning: %s" % w)
+    return model
+
+#############################################################################
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+#
+# bayes_sim.py - fleet simulator for the bayes.py node/cluster tasks
+#
+# Every --interval seconds, the ping/cpu/mem/reject metrics of --instances
+# instances are written (through the sharded prom write path, or to a
+# remote-write endpoint with --remote_write). Instances go through episodes:
+# "overload", "ddos" (also fleet-wide waves) and "failure" (no samples).
+# --speed N runs the episodes N times faster than real time; samples are
+# always stamped with the wall time of their write, so ticks are at least a
+# second apart.
+#
+# A poller reads the mdtsdb_node_eval_status output of observe_mdtsdb_nodes
+# and reports the end-to-end latency from the write of a sample to the
+# timestamp of the first output that covers it (server and client clocks are
+# assumed to be in sync), and how the output risks match the episodes.
+#
+
+from __future__ import print_function
+import argparse, os, sys, json, random, time, threading, collections
+import urllib.request, urllib.error
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
+
+import utils
+from utils import (ConnectionError, create_clients, open_creds, client_pool, imap_concurrently, latency_report)
+import prom, inspect_prom, remote_write
+from bayes import (CREDS, METRIC_PING, METRIC_CPU, METRIC_MEM, METRIC_REJECT, METRIC_NODE_EVAL_STATUS)
+
+EPISODES = ['normal', 'overload', 'ddos', 'failure']
+# metric -> episode -> (low, high) of uniformly distributed values
+PROFILES = {
+    METRIC_PING:   {'normal': (5, 40),      'overload': (100, 600), 'ddos': (500, 2000)},
+    METRIC_CPU:    {'normal': (0.05, 0.3),  'overload': (0.6, 0.95), 'ddos': (0.4, 0.9)},
+    METRIC_MEM:    {'normal': (0.1, 0.3),   'overload': (0.5, 0.9),  'ddos': (0.2, 0.5)},
+    METRIC_REJECT: {'normal': (0.0, 0.001), 'overload': (0.05, 0.3), 'ddos': (0.2, 0.9)}
+}
+CLUSTER_SENSORS = 6001 # observe_mdtsdb_cluster reads $0-$6000 of the node report swimlane
+RISK_THRESHOLD = 0.5
+
+#############################################################################
+
+class Fleet(object):
+    def __init__(self, args):
+        self.args = args
+        self.instances = ["node%05d:9100" % i for i in range(args.instances)]
+        self.episodes = dict([(i, ('normal', 0)) for i in self.instances]) # instance -> (episode, until)
+        self.counts = collections.Counter()
+
+    def step(self, t):
+        a = self.args
+        wave = a.ddos_wave > 0 and random.random() < a.ddos_wave_rate * a.interval / 60.0
+        for i in self.instances:
+            (episode, until) = self.episodes[i]
+            if episode != 'normal' and t >= until:
+                episode = 'normal'
+            if episode == 'normal':
+                if wave and random.random() < a.ddos_wave:
+                    episode = 'ddos'
+                else:
+                    r = random.random() * 60.0 / a.interval
+                    for (name, rate) in [('failure', a.failure_rate), ('overload', a.overload_rate), ('ddos', a.ddos_rate)]:
+                        if r < rate:
+                            episode = name
+                            break
+                        r -= rate
+                if episode != 'normal':
+                    until = t + random.randint(a.episode_min, a.episode_max)
+                    self.counts[episode] += 1
+            self.episodes[i] = (episode, until)
+
+    def samples(self, t):
+        data = []
+        for i in self.instances:
+            episode = self.episodes[i][0]
+            if episode == 'failure':
+                continue
+            for (metric, profile) in PROFILES.items():
+                (low, high) = profile[episode]
+                data.append({
+                    'ns': t,
+                    'value': round(random.uniform(low, high), 6),
+                    'series': {'__name__': metric, 'instance': i, 'job': 'mdtsdb'}
+                })
+        return data
+
+#############################################################################
+# Write sinks: data -> None
+
+def prom_sink(user, workers):
+    get_client = client_pool(user)
+    def insert(shard):
+        (key, payload) = shard
+        (ok, r) = get_client().insert(payload)
+        assert ok == 'ok', (key, ok, r)
+    def write(data):
+        for _ in imap_concurrently(insert, prom.shard_payloads(user, {}, data, workers), workers):
+            pass
+    return write
+
+def remote_write_sink(url, batch, workers):
+    def post(data):
+        series = [(d['series'], [(1000 * d['ns'], d['value'])]) for d in data]
+        req = urllib.request.Request(url, data=remote_write.snappy_compress(remote_write.encode_write_request(series)),
+            headers={'Content-Encoding': 'snappy', 'Content-Type': 'application/x-protobuf',
+                     'X-Prometheus-Remote-Write-Version': '0.1.0'})
+        for attempt in range(5):
+            try:
+                with urllib.request.urlopen(req) as resp:
+                    return resp.status
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+        raise IOError("remote write: the receiver is busy")
+    def write(data):
+        for _ in imap_concurrently(post, [data[i:i + batch] for i in range(0, len(data), batch)], workers):
+            pass
+    return write
+
+#############################################################################
+
+class OutputPoller(threading.Thread):
+    # reads new "when=now" node risks and matches them to written ticks
+    def __init__(self, user, fleet, args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_client = client_pool(user)
+        self.fleet = fleet
+        self.args = args
+        self.written = {}   # tick timestamp -> wall times of the start and the end of its write
+        self.latest = {}    # instance -> latest tick timestamp of an output
+        self.latencies = []
+        self.matches = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def tick_written(self, t, start, done):
+        with self.lock:
+            self.written[t] = (start, done)
+
+    def poll(self, t1, t2):
+        rows = inspect_prom.fetch_chunk(self.get_client, ("__name__", METRIC_NODE_EVAL_STATUS, "EQ"), t1, t2)
+        with self.lock:
+            ticks = sorted(self.written)
+            for (labels, samples) in rows:
+                if labels.get("when") != "now":
+                    continue
+                instance = labels.get("instance")
+                for (t_ms, value) in samples:
+                    # the output covers the latest tick written before it was computed
+                    covered = [t for t in ticks if self.written[t][1] <= t_ms / 1000.0]
+                    if not covered or covered[-1] <= self.latest.get((instance, labels.get("risk")), 0):
+                        continue
+                    self.latest[(instance, labels.get("risk"))] = covered[-1]
+                    if labels.get("risk") == "ddos":
+                        self.latencies.append(t_ms - 1000 * self.written[covered[-1]][0])
+                    episode = self.fleet.episodes.get(instance, ('normal', 0))[0]
+                    self.matches[(labels.get("risk"), episode, value >= RISK_THRESHOLD)] += 1
+
+    def run(self):
+        t1 = int(time.time())
+        while not self.stopped.wait(self.args.poll):
+            t2 = int(time.time()) + 1
+            try:
+                self.poll(t1 - self.args.poll_overlap, t2)
+            except (AssertionError, ConnectionError) as e:
+                print("poll: %s" % e)
+            t1 = t2
+
+    def report(self):
+        lines = ["end-to-end latency (write -> first ddos risk output): %s" % latency_report(self.latencies)]
+        for risk in ['crash', 'ddos', 'overload']:
+            row = ["%s(%d/%d)" % (episode, self.matches[(risk, episode, True)],
+                   self.matches[(risk, episode, True)] + self.matches[(risk, episode, False)]) for episode in EPISODES]
+            lines.append("%s risk >= %s by episode (high/all): %s" % (risk, RISK_THRESHOLD, ", ".join(row)))
+        return "\n".join(lines)
+
+#############################################################################
+
+def simulate(args, creds):
+    if 6 * args.instances > CLUSTER_SENSORS:
+        print("WARNING: %d instances give %d node report series, observe_mdtsdb_cluster reads %d" % (
+            args.instances, 6 * args.instances, CLUSTER_SENSORS))
+    user = None
+    if not args.dry_run and (not args.remote_write or args.poll > 0):
+        r = create_clients(args.test, creds)
+        if r is None:
+            raise ValueError("unknown test scenario: %d" % args.test)
+        (user, _, attrs) = r
+    if args.dry_run:
+        write = lambda data: None
+    elif args.remote_write:
+        write = remote_write_sink(args.remote_write, args.batch, args.workers)
+    else:
+        write = prom_sink(user, args.workers)
+
+    fleet = Fleet(args)
+    poller = None
+    if user and args.poll > 0:
+        poller = OutputPoller(user, fleet, args)
+        poller.start()
+
+    t0 = int(time.time())
+    wall0 = time.time()
+    write_ms, samples, last = [], 0, 0
+    for tick in range(args.duration // args.interval):
+        # episodes run on the simulated clock, samples are stamped with the
+        # wall time of their write (at most one tick per second)
+        fleet.step(t0 + tick * args.interval)
+        if int(time.time()) <= last:
+            time.sleep(last + 1 - time.time())
+        w = time.time()
+        last = int(w)
+        data = fleet.samples(last)
+        write(data)
+        write_ms.append(1000 * (time.time() - w))
+        samples += len(data)
+        if poller:
+            poller.tick_written(last, w, time.time())
+        if args.verbose:
+            states = collections.Counter([e for (e, _) in fleet.episodes.values()])
+            print("tick %d: %d samples, write: %d ms, %s" % (tick, len(data), write_ms[-1], dict(states)))
+        if args.speed > 0:
+            time.sleep(max(0.0, wall0 + (tick + 1) * args.interval / args.speed - time.time()))
+
+    elapsed = time.time() - wall0
+    if poller:
+        time.sleep(args.drain)
+        poller.stopped.set()
+        poller.join()
+    print("instances: %d, ticks: %d, samples: %d, elapsed: %.1fs, rate: %d samples/s" % (
+        args.instances, len(write_ms), samples, elapsed, samples / max(elapsed, 1e-6)))
+    print("episodes: %s" % json.dumps(dict(fleet.counts), sort_keys=True))
+    print("write time per tick: %s" % latency_report(write_ms))
+    if poller:
+        print(poller.report())
+
+
+def main(args):
+    try:
+        simulate(args, open_creds(args, CREDS))
+    except ConnectionError as e:
+        print(e)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fleet simulator for the bayes.py tasks')
+    parser.add_argument('-s','--server', help='TimeEngine server host', required=False)
+    parser.add_argument('-p','--port', help='TimeEngine server port', required=False)
+    parser.add_argument('--use_https', help='Use https scheme', required=False, default=False, action='store_true')
+    parser.add_argument('-t', '--test', type=int, choices=range(1, 11), help='test scenario number', default=1)
+    parser.add_argument('--creds', help="file with credential info", required=False)
+    parser.add_argument('--instances', type=int, help="Number of instances", required=False, default=1000)
+    parser.add_argument('--duration', type=int, help="Simulated seconds", required=False, default=900)
+    parser.add_argument('--interval', type=int, help="Seconds between samples of an instance", required=False, default=15)
+    parser.add_argument('--speed', type=float, help="Pace: 1 - real time, N - N times faster, 0 - as fast as possible (at most a tick per second)", required=False, default=1.0)
+    parser.add_argument('--overload_rate', type=float, help="Overload episodes per instance per minute", required=False, default=0.002)
+    parser.add_argument('--ddos_rate', type=float, help="DDoS episodes per instance per minute", required=False, default=0.001)
+    parser.add_argument('--failure_rate', type=float, help="Failure (silent) episodes per instance per minute", required=False, default=0.0005)
+    parser.add_argument('--ddos_wave', type=float, help="Share of the fleet a DDoS wave hits", required=False, default=0.3)
+    parser.add_argument('--ddos_wave_rate', type=float, help="DDoS waves per minute", required=False, default=0.05)
+    parser.add_argument('--episode_min', type=int, help="Min episode seconds", required=False, default=120)
+    parser.add_argument('--episode_max', type=int, help="Max episode seconds", required=False, default=600)
+    parser.add_argument('--remote_write', help="Write to the remote-write URL (see remote_write.py) instead of the prom write path", required=False)
+    parser.add_argument('--batch', type=int, help="Samples per remote-write request", required=False, default=5000)
+    parser.add_argument('--workers', type=int, help="Number of concurrent writes", required=False, default=4)
+    parser.add_argument('--poll', type=int, help="Poll the node risks every given number of seconds (0 - no latency measurement)", required=False, default=5)
+    parser.add_argument('--poll_overlap', type=int, help="Re-read the given number of seconds before the last poll", required=False, default=120)
+    parser.add_argument('--drain', type=int, help="Seconds to keep polling after the last tick", required=False, default=180)
+    parser.add_argument('--dry_run', help='Generate data only', required=False, action='store_true')
+    parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.server != None:
+        utils.HOST = args.server
+    if args.port != None:
+        utils.PORT = int(args.port)
+    if args.use_https != None:
+        utils.ISHTTPS = args.use_https
+
+    main(args)
+
+#############################################################################
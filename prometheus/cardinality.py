@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+#
+# cardinality.py - label cardinality tracking and limiting on the Prometheus write path
+#
+# Distinct values are estimated with HyperLogLog sketches: one per (metric, label)
+# and one per metric for its series (label sets). Metric names are tracked by
+# name prefix (the name without its last "_" part), so generated names like
+# "rabbitmq_q_ABCD" show up as one exploding "rabbitmq_q" family.
+#
+# When a label goes above the limit, its values seen from then on are dropped,
+# hashed into `limit` buckets, or aggregated into one "other" value (for
+# "__name__": a sample is dropped, or the name is replaced by a bucket/other
+# name of its prefix).
+#
+
+from __future__ import print_function
+import hashlib, math
+
+HLL_P = 12
+ACTIONS = ['report', 'drop', 'hash', 'aggregate']
+OTHER = "other"
+
+#############################################################################
+
+def hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HyperLogLog(object):
+    # registers are kept in a dict while few of them are set, then in a bytearray
+    def __init__(self, p = HLL_P):
+        self.p = p
+        self.m = 1 << p
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+        self.registers = {}
+        self.sparse = True
+        self.z = float(self.m)
+        self.zeros = self.m
+
+    def add(self, value):
+        x = hash64(value)
+        j = x & (self.m - 1)
+        rank = 64 - self.p - (x >> self.p).bit_length() + 1
+        old = self.registers.get(j, 0) if self.sparse else self.registers[j]
+        if rank > old:
+            if old == 0:
+                self.zeros -= 1
+            self.z += 2.0 ** -rank - 2.0 ** -old
+            self.registers[j] = rank
+            if self.sparse and len(self.registers) > self.m // 16:
+                dense = bytearray(self.m)
+                for i, r in self.registers.items():
+                    dense[i] = r
+                self.registers = dense
+                self.sparse = False
+
+    def count(self):
+        e = self.alpha * self.m * self.m / self.z
+        if e <= 2.5 * self.m and self.zeros > 0:
+            e = self.m * math.log(float(self.m) / self.zeros)
+        return int(round(e))
+
+#############################################################################
+
+def name_prefix(name):
+    return name.rsplit('_', 1)[0] if '_' in name else name
+
+
+class CardinalityTracker(object):
+    def __init__(self, limit = 0, action = 'report', p = HLL_P):
+        if action not in ACTIONS:
+            raise ValueError("unknown action: %s" % action)
+        self.limit = limit
+        self.action = action
+        self.p = p
+        self.labels = {}    # (metric or name prefix, label) -> HyperLogLog of values
+        self.series = {}    # metric -> HyperLogLog of label sets
+        self.limited = {}   # (metric or name prefix, label) -> number of changed samples
+        self.dropped = 0
+
+    def sketch(self, sketches, key):
+        hll = sketches.get(key)
+        if hll is None:
+            hll = sketches[key] = HyperLogLog(self.p)
+        return hll
+
+    def above_limit(self, key, value):
+        hll = self.sketch(self.labels, key)
+        hll.add(value)
+        return self.limit > 0 and self.action != 'report' and hll.count() > self.limit
+
+    def limit_value(self, key, value):
+        self.limited[key] = self.limited.get(key, 0) + 1
+        if self.action == 'hash':
+            return "h%x" % (hash64(value) % self.limit)
+        return OTHER
+
+    def apply(self, series):
+        # returns the series to write, or None if the sample is to be dropped
+        name = series.get('__name__', '')
+        key = (name_prefix(name), '__name__')
+        if self.above_limit(key, name):
+            if self.action == 'drop':
+                self.limited[key] = self.limited.get(key, 0) + 1
+                self.dropped += 1
+                return None
+            name = "%s_%s" % (key[0], self.limit_value(key, name))
+            series = dict(series, __name__=name)
+        out = {}
+        for label, value in series.items():
+            value = str(value)
+            if label != '__name__' and self.above_limit((name, label), value):
+                if self.action == 'drop':
+                    self.limited[(name, label)] = self.limited.get((name, label), 0) + 1
+                    continue
+                value = self.limit_value((name, label), value)
+            out[label] = value
+        self.sketch(self.series, name).add(','.join(['%s=%s' % kv for kv in sorted(out.items())]))
+        return out
+
+    def top(self, n = 10):
+        labels = sorted([(hll.count(), key) for key, hll in self.labels.items()], reverse=True)[:n]
+        series = sorted([(hll.count(), name) for name, hll in self.series.items()], reverse=True)[:n]
+        return labels, series
+
+    def report(self, n = 10):
+        labels, series = self.top(n)
+        lines = ["label cardinality (estimated), top %d:" % n]
+        for (count, (metric, label)) in labels:
+            if label == '__name__':
+                lines.append("    %s_*: %d metric names%s" % (metric, count, self.limited_note((metric, label))))
+            else:
+                lines.append("    %s{%s}: %d values%s" % (metric, label, count, self.limited_note((metric, label))))
+        lines.append("series per metric (estimated), top %d:" % n)
+        for (count, name) in series:
+            lines.append("    %s: %d" % (name, count))
+        if self.dropped:
+            lines.append("dropped samples: %d" % self.dropped)
+        return "\n".join(lines)
+
+    def limited_note(self, key):
+        if key in self.limited:
+            return " (above the limit %d: %s, %d samples)" % (self.limit, self.action, self.limited[key])
+        return ""
+
+#############################################################################
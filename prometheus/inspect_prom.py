@@ -2,16 +2,121 @@
 #
 # inspect_prom.py - inspect Prometheus metrics
 #
+# The window is read with select_metrics in time chunks fetched concurrently,
+# for one or more selectors; every (selector, chunk, series) is printed as a
+# JSON line: {"selector", "from", "to", "labels", "samples": [[t_ms, value]]}.
+# With --cache_dir, windows are step-aligned and only their part that is not
+# in the range cache is read; a line then holds the whole window of a series.
 #
 
 from __future__ import print_function
-import argparse, os, sys, json, random, time
+import argparse, os, sys, re, json, random, time
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 
 from mdtsdb import Mdtsdb
 import utils
 from utils import (new_user, ConnectionError, HOST, PORT, REQ_TIMEOUT, ISHTTPS)
+import range_cache
+
+MATCHER_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)(=~|!~|!=|=)(.*)$')
+MATCHER_RULES = {'=': 'EQ', '!=': 'NEQ', '=~': 'RE', '!~': 'NRE'}
+AGGREGATES = {
+    'last': lambda vs: vs[-1],
+    'first': lambda vs: vs[0],
+    'min': min,
+    'max': max,
+    'sum': sum,
+    'avg': lambda vs: float(sum(vs)) / len(vs),
+    'count': len
+}
+
+#############################################################################
+
+def parse_selector(text):
+    # 'instance=~"host.*"' -> ("instance", "host.*", "RE")
+    m = MATCHER_RE.match(text.strip())
+    if m is None:
+        raise ValueError("bad selector: %s" % text)
+    (label, op, value) = m.groups()
+    return (label, value.strip('"'), MATCHER_RULES[op])
+
+def selector_text(selector):
+    (label, value, rule) = selector
+    return '%s%s"%s"' % (label, dict([(v, k) for k, v in MATCHER_RULES.items()])[rule], value)
+
+def select_query(t1_ms, t2_ms, selector):
+    (label, value, rule) = selector
+    return """
+        L = select_metrics(%d, %d, [{"%s", "%s", '%s'}]),
+        lists::filtermap(fun
+            ({Labels, Samples = [_ | _]}) ->
+                {true, {Labels, [[T, V] || {T, V, _} <- Samples]}};
+            (_) ->
+                false
+        end, L).
+    """ % (t1_ms, t2_ms, label, value.replace('"', '\\"'), rule)
+
+def time_chunks(t1, t2, chunk):
+    # [t1, t2) in chunks aligned to the chunk size
+    c1 = t1
+    while c1 < t2:
+        c2 = min(t2, (c1 // chunk + 1) * chunk)
+        yield (c1, c2)
+        c1 = c2
+
+def downsample(samples, step, agg):
+    # samples: [[t_ms, value]] in time order -> one sample per step (the start of the step)
+    if not step:
+        return samples
+    step_ms = 1000 * step
+    out, bucket, values = [], None, []
+    for (t, v) in samples:
+        b = t - t % step_ms
+        if b != bucket and values:
+            out.append([bucket, AGGREGATES[agg](values)])
+            values = []
+        bucket = b
+        values.append(v)
+    if values:
+        out.append([bucket, AGGREGATES[agg](values)])
+    return out
+
+def fetch_chunk(get_client, selector, c1, c2, verbose = False):
+    # samples of the series matching the selector in [c1, c2) seconds
+    q = select_query(1000 * c1, 1000 * c2 - 1, selector)
+    if verbose:
+        print(q, file=sys.stderr)
+    (ok, r) = get_client().query(q)
+    assert ok == 'ok', (ok, r)
+    return r
+
+def iter_selected(client, selectors, t1, t2, chunk, workers, step = 0, agg = 'last', verbose = False):
+    # yields (selector, c1, c2, labels, samples) in the order of selectors and chunks;
+    # chunks are fetched concurrently
+    if step:
+        t1 -= t1 % step
+        chunk = max(step, chunk - chunk % step)
+    get_client = utils.client_pool(client)
+    items = [(selector, c1, c2) for selector in selectors for (c1, c2) in time_chunks(t1, t2, chunk)]
+    def fetch(item):
+        (selector, c1, c2) = item
+        return (item, fetch_chunk(get_client, selector, c1, c2, verbose))
+    for ((selector, c1, c2), r) in utils.imap_concurrently(fetch, items, workers):
+        for (labels, samples) in r:
+            yield (selector, c1, c2, labels, downsample(samples, step, agg))
+
+def iter_cached(cache, client, selectors, t1, t2, chunk, workers, step = 0, agg = 'last', verbose = False):
+    # as iter_selected, but one (selector, t1, t2, labels, samples) per series; only the
+    # part of the step-aligned window that is not in the cache is read
+    (t1, t2) = range_cache.align(t1, t2, step)
+    for selector in selectors:
+        def fetch(c1, c2):
+            return [(labels, samples) for (_, _, _, labels, samples) in iter_selected(
+                client, [selector], c1, c2, chunk, workers, step, agg, verbose)]
+        key = [selector_text(selector), selector[2], step, agg if step else None]
+        for (labels, samples) in cache.read(key, t1, t2, fetch, step + cache.fresh):
+            yield (selector, t1, t2, labels, samples)
 
 #############################################################################
 
@@ -34,28 +139,33 @@ def main(args):
         is_https=utils.ISHTTPS)
     t2 = int(time.time())
     t1 = t2 - int(args.dur)
-    if args.value == "node_cpu_seconds_total":
-        q = """
-            L = select_metrics(%d, %d, [{"%s", "%s", '%s'}]),
-            lists::filtermap(fun
-                ({#{<<"instance">> := Instance}, Samples = [_ | _]}) ->
-                    {true, {Instance, [CPU || {_, CPU, _} <- Samples]}};
-                (_) ->
-                    false
-            end, L).
-        """
+    if args.select:
+        selectors = [parse_selector(s) for s in args.select]
     else:
-        q = """
-            select_metrics(%d, %d, [{"%s", "%s", '%s'}]).
-        """
-    q = q % (1000 * t1, 1000 * t2, args.metric, args.value, args.rule)
-    print(q)
-    (Ok, r) = user_as_storage.query(q)
-    assert Ok == 'ok', (Ok, r)
-    if args.value == "node_cpu_seconds_total":
-        print(json.dumps(r, indent=4))
+        selectors = [(args.metric, args.value, args.rule)]
+
+    t = time.time()
+    (series, samples) = (set(), 0)
+    if args.cache_dir:
+        cache = range_cache.RangeCache(args.cache_dir, args.fresh)
+        rows = iter_cached(cache, user_as_storage, selectors, t1, t2, args.chunk, args.workers, args.step, args.agg, args.verbose)
     else:
-        print(r)
+        cache = None
+        rows = iter_selected(user_as_storage, selectors, t1, t2, args.chunk, args.workers, args.step, args.agg, args.verbose)
+    for (selector, c1, c2, labels, values) in rows:
+        print(json.dumps({
+            "selector": selector_text(selector),
+            "from": c1,
+            "to": c2,
+            "labels": labels,
+            "samples": values
+        }, sort_keys=True))
+        series.add((selector, json.dumps(labels, sort_keys=True)))
+        samples += len(values)
+    print("selectors: %d, series: %d, samples: %d, elapsed: %.3fs" % (
+        len(selectors), len(series), samples, time.time() - t), file=sys.stderr)
+    if cache:
+        print(cache.report(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -70,6 +180,15 @@ if __name__ == "__main__":
     parser.add_argument('--value', help="Metric value", required=False, default="node_cpu_seconds_total")
     parser.add_argument('--rule', help="PromQL rule: EQ, NEQ, RE, NRE", required=False, default="EQ", choices=["EQ", "NEQ", "RE", "NRE"])
     parser.add_argument('--dur', help="For the given number of seconds from now back", required=False, default=900, type=int)
+    parser.add_argument('--select', action='append', help="""Selector, e.g. '__name__="node_cpu_seconds_total"', 'instance=~"host.*"'
+        (=, !=, =~, !~); can be repeated; default: --metric, --value, --rule""", required=False)
+    parser.add_argument('--chunk', help="Read the window in chunks of the given number of seconds", required=False, default=300, type=int)
+    parser.add_argument('--workers', help="Number of concurrent chunk reads", required=False, default=4, type=int)
+    parser.add_argument('--step', help="Downsample to one sample per the given number of seconds (0 - raw samples)", required=False, default=0, type=int)
+    parser.add_argument('--agg', help="Downsampling aggregate", required=False, default="last", choices=sorted(AGGREGATES))
+    parser.add_argument('--fresh', type=int, help="Seconds of late samples that are read every time, not cached", required=False, default=range_cache.FRESH)
+    parser.add_argument('--cache_dir', help="Keep read ranges in the directory and read only new data (one line per series)", required=False)
+    parser.add_argument('--verbose', help='Print queries to stderr', required=False, action='store_true', default=False)
 
     args = parser.parse_args()
 
@@ -11,11 +11,15 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../c
 
 from mdtsdb import Mdtsdb
 import utils
-from utils import (new_user, ConnectionError, create_clients, update_clients, open_creds, HOST, PORT, REQ_TIMEOUT, ISHTTPS)
+from utils import (new_user, ConnectionError, create_clients, update_clients, open_creds, HOST, PORT, REQ_TIMEOUT, ISHTTPS,
+    client_pool, imap_concurrently)
+import cardinality
+import range_cache, inspect_prom
 
 CREDS = 'prom.json'
 
 MEASUREMENT = "default"
+PARTITION_LABELS = ["__name__"]
 USER_ENV = """
 user env (
     retention_policy: #{
@@ -31,13 +35,69 @@ user env (
                     "insert": false, "delete": false, "timeframe": false, "schema": false
                 }
             },
-            "series": ["__name__"]
+            "series": %s
             %%"series": ["__name__", "instance"]
         }
     }
 ) end,
 get_report("measurements").
-""" % (MEASUREMENT)
+""" % (MEASUREMENT, json.dumps(PARTITION_LABELS))
+
+
+# Rollups: every source swimlane (one per metric name) gets a tumbling task per
+# rollup step that publishes min/max/sum/count of every series in the step as
+# the metric "<name>:rollup_<step>" with the extra label "agg"; the prom
+# partitioning by "__name__" gives every rollup metric its own swimlane.
+ROLLUPS = [("1m", 60), ("5m", 300), ("1h", 3600)]
+ROLLUP_SUFFIX = ":rollup_"
+ROLLUP_TASK = """
+use("%(swimlane)s").
+task "%(task)s" (
+    window: "tumbling",
+    sz: %(step)d,
+
+    real_time: true,
+    save: false,
+
+    options: #{
+        "report_data_drop": true,
+        "report_insert_drop": true,
+        "permanent": true
+    },
+
+    partition: def (swimlane, sensor_no, _, _) ->
+        get_sensor_label(swimlane, sensor_no)
+    end,
+
+    result: def (task_props, n, values) ->
+        case values of
+            [] ->
+                'null';
+            _ ->
+                {lists::min(values), lists::max(values), lists::sum(values), length(values)}
+        end
+    end,
+
+    collect_by_key: def (task_props, t1, t2, labels, result) ->
+        case result of
+            {v_min, v_max, v_sum, v_count} ->
+                t_ms = t1 div 1_000_000,
+                rollup = labels#{"__name__": format("~s%(suffix)s%(rollup)s", [maps::get("__name__", labels)])},
+                send_metrics([
+                    {rollup#{"agg": "min"},   [{t_ms, v_min}]},
+                    {rollup#{"agg": "max"},   [{t_ms, v_max}]},
+                    {rollup#{"agg": "sum"},   [{t_ms, v_sum}]},
+                    {rollup#{"agg": "count"}, [{t_ms, v_count}]}
+                ]),
+                result;
+            _ ->
+                result
+        end
+    end
+)
+from ["%(swimlane)s".$0-$%(upper)d]
+end.
+"""
 
 
 #############################################################################
@@ -81,6 +141,45 @@ def write(args, creds):
     return write1(args, creds, args.num)
 
 
+def partition_tags(series):
+    return tuple([(label, str(series.get(label, ""))) for label in PARTITION_LABELS])
+
+
+# swimlane keys by (user, partition tags); a swimlane is not created by a
+# lookup, so unresolved tags are looked up again on the next write
+SWIMLANES = {}
+
+def resolve_swimlanes(user, tags_list, workers):
+    get_client = client_pool(user)
+    def resolve(tags):
+        q = "tags_to_swimlane(#{%s})." % ", ".join(["%s: %s" % (json.dumps(k), json.dumps(v)) for (k, v) in tags])
+        (ok, sw) = get_client().query(q)
+        return (tags, sw if ok == 'ok' and isinstance(sw, str) else None)
+    missing = [tags for tags in tags_list if (user.admin_key, tags) not in SWIMLANES]
+    for (tags, sw) in imap_concurrently(resolve, missing, workers):
+        if sw is not None:
+            SWIMLANES[(user.admin_key, tags)] = sw
+    return {tags: SWIMLANES.get((user.admin_key, tags)) for tags in tags_list}
+
+
+def shard_payloads(user, series, data, workers):
+    # one payload per destination swimlane; samples of not yet created
+    # swimlanes are grouped by their partition tags
+    groups = {}
+    for d in data:
+        groups.setdefault(partition_tags(dict(series, **d['series'])), []).append(d)
+    swimlanes = resolve_swimlanes(user, list(groups), workers)
+    shards = {}
+    for tags, items in groups.items():
+        key = swimlanes[tags] or ",".join(["%s=%s" % kv for kv in tags])
+        shards.setdefault(key, []).extend(items)
+    return [(key, [{
+        'measurement': MEASUREMENT,
+        'series': series,
+        'data': items
+    }]) for key, items in sorted(shards.items())]
+
+
 def write1(args, creds, n):
     r = create_clients(args.test, creds)
     if r is None:
@@ -90,7 +189,19 @@ def write1(args, creds, n):
     (ok, sws) = user.query("get_swimlanes().")
     assert ok == 'ok'
 
+    get_client = client_pool(user)
+    def insert(shard):
+        (key, payload) = shard
+        t = time.time()
+        try:
+            (ok, r) = get_client().insert(payload)
+        except ConnectionError as e:
+            (ok, r) = ('error', repr(e))
+        return (key, len(payload[0]['data']), ok, r, (time.time() - t) * 1000)
+
+    tracker = cardinality.CardinalityTracker(args.label_limit, args.label_action)
     t0 = int(time.time())
+    errors = []
     for job in ['node', 'prometheus']:
         series = {
             'job': job,
@@ -98,26 +209,34 @@ def write1(args, creds, n):
         }
         data = []
         for ti in range(t0, t0 + n):
-            data.append(datafun(args, ti))
-        payload = [{
-            'measurement': MEASUREMENT,
-            'series': series,
-            'data': data
-        }]
+            d = datafun(args, ti)
+            d['series'] = tracker.apply(d['series'])
+            if d['series'] is not None:
+                data.append(d)
+        shards = shard_payloads(user, series, data, args.write_workers)
         if args.verbose:
-            print(payload)
-        (Ok, r) = user.insert(payload)
-
-    if args.verbose:
-        print("Server write details:")
-        print(json.dumps(r, indent=4, sort_keys=True))
-    try:
-        for _, v in r['batch'].items():
-            print("server write time: %d ms" % v['result']['info']['ms'])
-    except KeyError:
-        pass
-
-    print("OK: Data are written, scenario: %d" % args.test)
+            print(shards)
+        for (key, samples, ok, r, ms) in imap_concurrently(insert, shards, args.write_workers):
+            if ok != 'ok':
+                errors.append((key, samples, r))
+                continue
+            if args.verbose:
+                print("Server write details (%s):" % key)
+                print(json.dumps(r, indent=4, sort_keys=True))
+            try:
+                server_ms = sum([v['result']['info']['ms'] for _, v in r['batch'].items()])
+                print("%s: %d samples, server write time: %d ms, request: %d ms" % (key, samples, server_ms, ms))
+            except (KeyError, TypeError):
+                print("%s: %d samples, request: %d ms" % (key, samples, ms))
+
+    if args.verbose or args.label_limit > 0:
+        print(tracker.report(args.label_top))
+    for (key, samples, r) in errors:
+        print("ERROR: %s: %d samples are not written: %s" % (key, samples, r))
+    if errors:
+        print("FAILED: %d swimlane writes, scenario: %d" % (len(errors), args.test))
+    else:
+        print("OK: Data are written, scenario: %d" % args.test)
 
 
 def update_env(args, creds):
@@ -138,6 +257,144 @@ def update_env(args, creds):
     print("OK: User environment is updated: %d" % args.test)
 
 
+def rollup_task_name(rollup, sw, sensors):
+    return "rollup_%s_%s_%d" % (rollup, sw, sensors)
+
+
+def rollups(args, creds):
+    r = create_clients(args.test, creds)
+    if r is None:
+        raise ValueError("unknown test scenario: %d" % args.test)
+
+    (user, _, attrs) = r
+    (ok, tasks) = user.query("user_tasks().")
+    assert ok == 'ok', (ok, tasks)
+    (ok, sws) = user.query("get_swimlanes().")
+    assert ok == 'ok', (ok, sws)
+    created, kept = 0, 0
+    for sw in sws:
+        (ok, opts) = user.query('get_swimlane_opts("%s").' % sw)
+        assert ok == 'ok', (ok, opts)
+        name = opts["opts"].get("partition_info", {}).get("__name__", "")
+        sensors = len(opts["labels"])
+        if ROLLUP_SUFFIX in name or sensors == 0:
+            continue
+        for (rollup, step) in ROLLUPS:
+            task = rollup_task_name(rollup, sw, sensors)
+            if task in tasks:
+                kept += 1
+                continue
+            # the number of series has changed: replace the task
+            prefix = "rollup_%s_%s_" % (rollup, sw)
+            for old in [t for t in tasks if t.startswith(prefix)]:
+                (ok, r) = user.query("""delete_task("%s").""" % old)
+                assert ok == 'ok', (ok, r)
+            q = ROLLUP_TASK % {
+                "swimlane": sw,
+                "task": task,
+                "step": step,
+                "rollup": rollup,
+                "suffix": ROLLUP_SUFFIX,
+                "upper": sensors - 1
+            }
+            if args.verbose:
+                print(q)
+            (ok, r) = user.query(q)
+            assert ok == 'ok', (ok, r)
+            created += 1
+    print("OK: rollup tasks: created %d, up to date %d, scenario: %d" % (created, kept, args.test))
+
+
+def choose_rollup(range_s, min_points):
+    # the coarsest rollup that still gives min_points steps over the range
+    adequate = [(step, rollup) for (rollup, step) in ROLLUPS if range_s // step >= min_points]
+    if adequate:
+        (step, rollup) = max(adequate)
+        return (rollup, step)
+    return None
+
+
+def read_counts(args, user):
+    t2 = int(time.time())
+    t1 = t2 - args.range
+    r = choose_rollup(args.range, args.min_points)
+    if args.range_cache:
+        return read_counts_cached(args, user, t1, t2, r)
+    res = select_counts(user, args.metric, t1, t2, r[0] if r else None, args.verbose)
+    print("read from: %s" % ("rollup %s" % r[0] if r else "raw samples"))
+    print(json.dumps(res, indent=4))
+
+
+def select_counts(user, metric, t1, t2, rollup, verbose):
+    # [[labels, samples]] of the series of metric in [t1, t2)
+    if rollup is not None:
+        # samples per series is the sum of the "count" aggregates
+        selector = """[{"__name__", "%s%s%s", 'EQ'}, {"agg", "count", 'EQ'}]""" % (metric, ROLLUP_SUFFIX, rollup)
+        total = "lists:sum([V || {_, V, _} <- Samples])"
+    else:
+        selector = """[{"__name__", "%s", 'EQ'}]""" % metric
+        total = "length(Samples)"
+    q = """
+        L = select_metrics(%d, %d, %s),
+        lists::map(fun ({Labels, Samples}) -> {Labels, %s} end, L).
+    """ % (1000 * t1, 1000 * t2, selector, total)
+    (ok, res) = user.query(q)
+    assert ok == "ok", res
+    if verbose:
+        print(q)
+    return res
+
+
+def count_recent(args, user, tasks, sw, sensors, recent, range_s):
+    # count(*) of the series of sw over the last range_s seconds (recent): from the
+    # coarsest adequate rollup if its task runs, else from raw samples
+    (ok, opts) = user.query('get_swimlane_opts("%s").' % sw)
+    assert ok == 'ok', (ok, opts)
+    name = opts["opts"].get("partition_info", {}).get("__name__", "")
+    r = choose_rollup(range_s, args.min_points)
+    if r is not None and name and ROLLUP_SUFFIX not in name and \
+            [t for t in tasks if t.startswith("rollup_%s_%s_" % (r[0], sw))]:
+        t2 = int(time.time())
+        res = select_counts(user, name, t2 - range_s, t2, r[0], args.verbose)
+        if args.verbose:
+            print("%s: rollup %s" % (sw, r[0]))
+            print(res)
+        return res
+    q = """
+        use("%s").
+        read (dense: true) $0-$%d select count(*) from recent "%s" end.
+    """ % (sw, sensors - 1, recent)
+    (ok, res) = user.query(q)
+    assert ok == "ok", res
+    if args.verbose:
+        print("%s: raw samples" % sw)
+        print(q)
+        print(res)
+    return res
+
+
+def read_counts_cached(args, user, t1, t2, r):
+    # the same counts from samples kept in the range cache: a repeated read
+    # only fetches the steps since the previous one
+    cache = range_cache.RangeCache(args.range_cache, args.fresh)
+    if r is not None:
+        (rollup, step) = r
+        selector = ("__name__", "%s%s%s" % (args.metric, ROLLUP_SUFFIX, rollup), "EQ")
+    else:
+        step = 0
+        selector = ("__name__", args.metric, "EQ")
+    res = []
+    for (_, _, _, labels, samples) in inspect_prom.iter_cached(
+            cache, user, [selector], t1, t2, args.chunk, args.workers, step, 'last', args.verbose):
+        if r is None:
+            res.append([labels, len(samples)])
+        elif labels.get("agg") == "count":
+            res.append([dict([(k, v) for k, v in labels.items() if k != "agg"]), sum([v for (_, v) in samples])])
+    print("read from: %s" % ("rollup %s" % r[0] if r else "raw samples"))
+    print(json.dumps(res, indent=4))
+    print(cache.report())
+
+
 def datafun_2(args, ti):
     if args.filter > 0 and ti % 3 == 0:
         d = {
@@ -295,6 +552,9 @@ def read_scenario(args, creds):
     if r is not None:
         (user, _, attrs) = r
         (ok, sws) = user.query("get_swimlanes().")
+        assert ok == "ok", sws
+        (ok, tasks) = user.query("user_tasks().")
+        assert ok == "ok", tasks
         if args.query == 1:
             d = []
             for sw in sws:
@@ -302,15 +562,7 @@ def read_scenario(args, creds):
                 assert ok == "ok", r
                 d.append((r["utilized_sensors"], sw))
             (sensors, sw) = max(d)
-            q = """
-                use("%s").
-                read (dense: true) $0-$%d select count(*) from recent "90m" end.
-            """ % (sw, sensors - 1)
-            (ok, r) = user.query(q)
-            assert ok == "ok", r
-            if args.verbose:
-                print(q)
-                print(r)
+            count_recent(args, user, tasks, sw, sensors, "90m", 90 * 60)
         elif args.query == 2:
             cb = 5
             d = []
@@ -320,33 +572,20 @@ def read_scenario(args, creds):
                 d.append((r["utilized_sensors"], sw))
             d.sort(reverse=True)
             for (sensors, sw) in d:
-                q = """
-                    use("%s").
-                    read (dense: true) $0-$%d select count(*) from recent "2H" end.
-                """ % (sw, sensors - 1)
-                (ok, r) = user.query(q)
-                assert ok == "ok", r
                 if args.verbose:
                     print("*" * 10)
-                    print(q)
-                    print(r)
+                count_recent(args, user, tasks, sw, sensors, "2H", 2 * 3600)
                 cb -= 1
                 if cb == 0:
                     break
+        elif args.query == 3:
+            read_counts(args, user)
         else:
             sw = sws[0]
             (ok, r) = user.query('get_report("describe_swimlane", #{"key" => "%s"}).' % sw)
             assert ok == "ok", r
             sensors = r["utilized_sensors"]
-            q = """
-                use("%s").
-                read (dense: true) $0-$%d select count(*) from recent "90m" end.
-            """ % (sw, sensors - 1)
-            (ok, r) = user.query(q)
-            assert ok == "ok", r
-            if args.verbose:
-                print(q)
-                print(r)
+            count_recent(args, user, tasks, sw, sensors, "90m", 90 * 60)
     else:
         print("unknown test scenario: %d" % args.test)
 
@@ -374,6 +613,8 @@ def main(args):
             r = update_env(args, creds)
         elif args.write:
             r = write(args, creds)
+        elif args.rollups:
+            r = rollups(args, creds)
         elif args.validate:
             r = validate(args, creds)
         elif args.info:
@@ -401,14 +642,31 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--test', type=int, choices=range(1, 101), help='test scenario number', default=1)
     parser.add_argument('-c','--create', help='Create Prometheus User', required=False, action='store_true')
     parser.add_argument('-w','--write', help='Write data', required=False, action='store_true')
-    parser.add_argument('-q', '--query', type=int, choices=range(1, 11), help="""Read scenario""", required=False, default=1)
+    parser.add_argument('-q', '--query', type=int, choices=range(1, 11), help="""Read scenario:
+        1 - count(*) of the largest swimlane over 90m,
+        2 - count(*) of the 5 largest swimlanes over 2h (both from the coarsest adequate rollup, if maintained),
+        3 - samples per series of --metric over --range (from the coarsest adequate rollup)
+    """, required=False, default=1)
+    parser.add_argument('-r','--rollups', help='Create/update rollup tasks for all metrics', required=False, action='store_true')
+    parser.add_argument('--metric', help="Metric name (read scenario 3)", required=False, default="node_memory_Active_anon_bytes")
+    parser.add_argument('--range', type=int, help="Read range in seconds from now back (read scenario 3)", required=False, default=5400)
+    parser.add_argument('--min_points', type=int, help="Min number of rollup steps in the read range (read scenarios 1-3)", required=False, default=60)
+    parser.add_argument('--fresh', type=int, help="Seconds of late samples that the range cache reads every time", required=False, default=range_cache.FRESH)
+    parser.add_argument('--range_cache', help="Directory of the range cache (read scenario 3 reads only new steps)", required=False)
+    parser.add_argument('--chunk', type=int, help="Read ranges in chunks of the given number of seconds", required=False, default=300)
+    parser.add_argument('--workers', type=int, help="Number of concurrent chunk reads", required=False, default=4)
     parser.add_argument('-v','--validate', help='Validate data', required=False, action='store_true')
     parser.add_argument('-d','--delete', help='Clean data', required=False, action='store_true')
     parser.add_argument('-i','--info', help='Print info about Prometheus User', required=False, action='store_true')
     parser.add_argument('-z','--size', type=int, help='Print summary about Prometheus User', required=False)
     parser.add_argument('-e','--env', help='Update User environment', required=False, action='store_true')
     parser.add_argument('-n', '--num', type=int, help="""Number of data points to write""", required=False, default=100)
+    parser.add_argument('--write_workers', type=int, help="Number of concurrent per-swimlane inserts", required=False, default=4)
     parser.add_argument('--filter', type=int, choices=range(0, 3), help="Generate data for filtering", required=False, default=1)
+    parser.add_argument('--label_limit', type=int, help="Max estimated number of values of a label (0 - no limit)", required=False, default=0)
+    parser.add_argument('--label_action', help="What to do with values of a label above --label_limit", required=False,
+                        choices=cardinality.ACTIONS, default='report')
+    parser.add_argument('--label_top', type=int, help="Number of labels/metrics in the cardinality report", required=False, default=10)
     parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
     parser.add_argument('--creds', help="file with credential info", required=False)
     parser.add_argument('--user', help="Prometheus User", required=False, default="MyPromUser")
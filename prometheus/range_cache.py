@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+#
+# range_cache.py - step-aligned cache of select_metrics ranges
+#
+# An entry is keyed by (selector, rule, step[, agg]) and holds the samples of
+# every matching series over [start, end) seconds. A read of [t1, t2) fetches
+# only what the entry does not cover (usually the tail [end, t2 - lag)), splices
+# it in and drops samples before t1. Reads are aligned down to the step. The
+# last lag seconds (--fresh, plus a step for rollups, whose aggregate of a
+# closed step is published later) are read every time and never cached, so late
+# samples and incomplete steps are not kept. Entries are JSON files in a
+# directory and survive between runs.
+#
+
+from __future__ import print_function
+import os, json, hashlib
+
+FRESH = 60
+
+#############################################################################
+
+def series_key(labels):
+    return json.dumps(labels, sort_keys=True)
+
+def merge_series(rows):
+    # (labels, samples) of consecutive chunks -> {series key: (labels, samples)}
+    series = {}
+    for (labels, samples) in rows:
+        key = series_key(labels)
+        if key in series:
+            series[key][1].extend(samples)
+        else:
+            series[key] = (labels, list(samples))
+    return series
+
+def align(t1, t2, step):
+    step = max(1, step)
+    return (t1 - t1 % step, t2 - t2 % step)
+
+
+class RangeCache(object):
+    def __init__(self, path, fresh = FRESH):
+        self.path = path
+        self.fresh = fresh  # seconds of late samples, never cached
+        self.fetched = 0    # seconds read from the server
+        self.served = 0     # seconds returned
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest() + ".json")
+
+    def load(self, key):
+        try:
+            with open(self.entry_path(key)) as fd:
+                entry = json.load(fd)
+        except (IOError, ValueError):
+            return None
+        return entry if entry.get('key') == json.loads(json.dumps(key)) else None
+
+    def save(self, key, entry):
+        path = self.entry_path(key)
+        with open(path + ".tmp", 'w') as fd:
+            json.dump(dict(entry, key=key), fd)
+        os.replace(path + ".tmp", path)
+
+    def read(self, key, t1, t2, fetch, lag = None):
+        # fetch(t1, t2) -> [(labels, samples)] of [t1, t2); samples are [[t_ms, value]];
+        # the last lag seconds (default: fresh) may still change and are read every time
+        lag = self.fresh if lag is None else lag
+        stable = max(t1, t2 - lag)
+        entry = self.load(key)
+        if entry is None or entry['end'] < t1 or entry['start'] > stable:
+            entry = {'start': t1, 'end': t1, 'series': {}}
+        series = dict([(k, tuple(v)) for k, v in entry['series'].items()])
+        if t1 < entry['start']:
+            head = merge_series(fetch(t1, entry['start']))
+            self.fetched += entry['start'] - t1
+            for k, (labels, samples) in head.items():
+                series[k] = (labels, samples + series.get(k, (labels, []))[1])
+            entry['start'] = t1
+        if entry['end'] < stable:
+            tail = merge_series(fetch(entry['end'], stable))
+            self.fetched += stable - entry['end']
+            for k, (labels, samples) in tail.items():
+                series[k] = (labels, series.get(k, (labels, []))[1] + samples)
+            entry['end'] = stable
+        # samples before t1 are not read again by a sliding window, samples after
+        # the stable part (of an entry saved with a smaller lag) are read again
+        (t1_ms, stable_ms) = (1000 * t1, 1000 * stable)
+        if entry['start'] < t1 or entry['end'] > stable:
+            for k, (labels, samples) in list(series.items()):
+                samples = [s for s in samples if t1_ms <= s[0] < stable_ms]
+                if samples:
+                    series[k] = (labels, samples)
+                else:
+                    del series[k]
+            (entry['start'], entry['end']) = (t1, stable)
+        entry['series'] = series
+        self.save(key, entry)
+        out = dict([(k, (labels, list(samples))) for k, (labels, samples) in series.items()])
+        if stable < t2:
+            for k, (labels, samples) in merge_series(fetch(stable, t2)).items():
+                out.setdefault(k, (labels, []))[1].extend(samples)
+            self.fetched += t2 - stable
+        self.served += t2 - t1
+        return list(out.values())
+
+    def report(self):
+        return "range cache: read %ds of %ds from the server" % (self.fetched, self.served)
+
+#############################################################################
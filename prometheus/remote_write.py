@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+#
+# remote_write.py - Prometheus remote-write receiver forwarding samples to TimeEngine
+#
+# POST /api/v1/write accepts snappy-compressed protobuf WriteRequests. Decoded
+# series are queued (a full queue answers 503, so Prometheus retries later),
+# coalesced across requests into "measurement"/"series"/"data" batches, and
+# inserted by forwarder threads with retries.
+#
+# With --store_retention, received samples are also kept in a local sample
+# store (sample_store.py) and GET /api/v1/select?select=<selector>&dur=<s>
+# (or &from=<s>&to=<s>) answers from it while the window is covered, from
+# TimeEngine otherwise.
+#
+# Run against a Prometheus User created by prom.py (-t/--creds), or with
+# --stand_in to accept inserts locally; --selftest posts generated
+# WriteRequests to a receiver backed by the stand-in and checks the counts.
+#
+
+from __future__ import print_function
+import argparse, os, sys, json, random, time, struct, math, threading, queue, collections
+import urllib.request, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
+
+import utils
+from utils import (ConnectionError, create_clients, open_creds, client_pool)
+from prom import CREDS, MEASUREMENT
+import inspect_prom, sample_store
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+WRITE_PATH = "/api/v1/write"
+SELECT_PATH = "/api/v1/select"
+FLUSH = object()
+
+#############################################################################
+# Snappy (block format): python-snappy if installed, a plain decoder otherwise
+
+def uvarint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def read_uvarint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def snappy_uncompress(data):
+    if snappy:
+        return snappy.uncompress(data)
+    (n, pos) = read_uvarint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            length = tag >> 2
+            if length >= 60:
+                nbytes = length - 59
+                length = int.from_bytes(data[pos:pos + nbytes], 'little')
+                pos += nbytes
+            length += 1
+            out += data[pos:pos + length]
+            pos += length
+            continue
+        if kind == 1:
+            length = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            length = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            length = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        start = len(out) - offset
+        if offset <= 0 or start < 0:
+            raise ValueError("snappy: bad copy offset")
+        if offset >= length:
+            out += out[start:start + length]
+        else:
+            for i in range(length):
+                out.append(out[start + i])
+    if len(out) != n:
+        raise ValueError("snappy: bad length")
+    return bytes(out)
+
+def snappy_literal(out, data):
+    for i in range(0, len(data), 65536):
+        chunk = data[i:i + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 256:
+            out += bytes([60 << 2, n])
+        else:
+            out += bytes([61 << 2]) + n.to_bytes(2, 'little')
+        out += chunk
+
+def snappy_compress(data):
+    # a greedy compressor for the self-test (copies of 4..64 bytes within 64K)
+    if snappy:
+        return snappy.compress(data)
+    out = bytearray(uvarint(len(data)))
+    table, pos, lit, n = {}, 0, 0, len(data)
+    while pos + 4 <= n:
+        key = data[pos:pos + 4]
+        cand = table.get(key)
+        table[key] = pos
+        if cand is not None and pos - cand < 65536:
+            snappy_literal(out, data[lit:pos])
+            length = 4
+            while pos + length < n and length < 64 and data[cand + length] == data[pos + length]:
+                length += 1
+            out += bytes([((length - 1) << 2) | 2]) + (pos - cand).to_bytes(2, 'little')
+            pos += length
+            lit = pos
+        else:
+            pos += 1
+    snappy_literal(out, data[lit:])
+    return bytes(out)
+
+#############################################################################
+# Protobuf: prometheus.WriteRequest {1: repeated TimeSeries}, TimeSeries {1: repeated Label,
+# 2: repeated Sample}, Label {1: name, 2: value}, Sample {1: double value, 2: int64 timestamp ms}
+
+def iter_fields(buf):
+    pos = 0
+    while pos < len(buf):
+        (key, pos) = read_uvarint(buf, pos)
+        (field, wire) = (key >> 3, key & 7)
+        if wire == 0:
+            (value, pos) = read_uvarint(buf, pos)
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 2:
+            (size, pos) = read_uvarint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("protobuf: unsupported wire type %d" % wire)
+        yield (field, wire, value)
+
+def int64(n):
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def decode_write_request(buf):
+    series = []
+    for (field, wire, ts) in iter_fields(memoryview(buf)):
+        if field != 1 or wire != 2:
+            continue # metadata
+        labels, samples = {}, []
+        for (f, w, v) in iter_fields(ts):
+            if f == 1 and w == 2:
+                label = dict([(lf, lv) for (lf, _, lv) in iter_fields(v)])
+                labels[bytes(label.get(1, b'')).decode('utf-8')] = bytes(label.get(2, b'')).decode('utf-8')
+            elif f == 2 and w == 2:
+                sample = dict([(sf, sv) for (sf, _, sv) in iter_fields(v)])
+                value = struct.unpack('<d', bytes(sample.get(1, b'\0' * 8)))[0]
+                samples.append((int64(sample.get(2, 0)), value))
+        series.append((labels, samples))
+    return series
+
+def pb_field(field, data):
+    return uvarint((field << 3) | 2) + uvarint(len(data)) + data
+
+def encode_write_request(series):
+    out = bytearray()
+    for (labels, samples) in series:
+        ts = bytearray()
+        for (name, value) in sorted(labels.items()):
+            ts += pb_field(1, pb_field(1, name.encode('utf-8')) + pb_field(2, value.encode('utf-8')))
+        for (t, v) in samples:
+            ts += pb_field(2, b'\x09' + struct.pack('<d', v) + b'\x10' + uvarint(t & ((1 << 64) - 1)))
+        out += pb_field(1, bytes(ts))
+    return bytes(out)
+
+#############################################################################
+# Receiver
+
+class StandIn(object):
+    # a local stand-in for TimeEngine: accepts inserts and counts data records
+    def __init__(self, fail_rate = 0.0):
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.inserts = 0
+        self.records = 0
+
+    def insert(self, payload):
+        if random.random() < self.fail_rate:
+            return ('error', 'stand-in failure')
+        with self.lock:
+            self.inserts += 1
+            self.records += sum([len(p['data']) for p in payload])
+        return ('ok', {'status': 1})
+
+
+class Receiver(object):
+    def __init__(self, client_f, args):
+        self.client_f = client_f
+        self.batch = args.batch
+        self.flush_s = args.flush
+        self.retries = args.retries
+        self.forwarders = args.forwarders
+        self.requests = queue.Queue(args.queue)
+        self.batches = queue.Queue(2 * args.forwarders)
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.store = sample_store.SampleStore(args.store_retention) if args.store_retention else None
+
+    def count(self, key, n = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    def start(self):
+        threads = [threading.Thread(target=self.coalesce)] + [
+            threading.Thread(target=self.forward) for _ in range(self.forwarders)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, series):
+        try:
+            self.requests.put_nowait(series)
+        except queue.Full:
+            self.count('rejected_requests')
+            return False
+        self.count('requests')
+        return True
+
+    def flush(self):
+        # blocks until everything submitted so far has been forwarded
+        self.requests.put(FLUSH)
+        self.requests.join()
+        self.batches.join()
+
+    def coalesce(self):
+        data, deadline = [], None
+        while True:
+            timeout = max(0.0, deadline - time.time()) if deadline else None
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None and item is not FLUSH:
+                for (labels, samples) in item:
+                    for (t, v) in samples:
+                        if math.isnan(v) or math.isinf(v):
+                            self.count('skipped_samples') # staleness markers
+                            continue
+                        data.append({'ns': t // 1000, 'value': v, 'series': labels})
+                        if self.store:
+                            self.store.add(labels, t, v)
+                if deadline is None:
+                    deadline = time.time() + self.flush_s
+            due = item is None or item is FLUSH or (deadline is not None and time.time() >= deadline)
+            while len(data) >= self.batch or (data and due):
+                self.batches.put(data[:self.batch])
+                data = data[self.batch:]
+            if not data:
+                deadline = None
+            if item is not None:
+                self.requests.task_done()
+
+    def forward(self):
+        client = self.client_f()
+        while True:
+            data = self.batches.get()
+            try:
+                self.insert(client, data)
+            finally:
+                self.batches.task_done()
+
+    def insert(self, client, data):
+        payload = [{
+            'measurement': MEASUREMENT,
+            'series': {},
+            'data': data
+        }]
+        for attempt in range(self.retries + 1):
+            try:
+                (ok, r) = client.insert(payload)
+            except Exception as e:
+                # a failed attempt of any kind must not stop the forwarder
+                (ok, r) = ('error', repr(e))
+            if ok == 'ok':
+                self.count('inserts')
+                self.count('samples', len(data))
+                return
+            self.count('retries')
+            time.sleep(min(0.1 * 2 ** attempt, 10))
+        print("insert failed, %d samples are dropped: %s" % (len(data), r))
+        self.count('dropped_samples', len(data))
+
+
+def make_handler(receiver, verbose):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != WRITE_PATH:
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                series = decode_write_request(snappy_uncompress(body))
+            except Exception as e:
+                self.send_error(400, repr(e))
+                return
+            if receiver.submit(series):
+                self.send_response(204)
+                self.end_headers()
+            else:
+                self.send_error(503, "queue is full")
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            if url.path != SELECT_PATH or receiver.store is None or 'select' not in params:
+                self.send_error(404)
+                return
+            try:
+                selectors = [inspect_prom.parse_selector(s) for s in params['select']]
+                t2 = int(params.get('to', [time.time()])[0])
+                t1 = int(params['from'][0]) if 'from' in params else t2 - int(params.get('dur', [900])[0])
+            except ValueError as e:
+                self.send_error(400, repr(e))
+                return
+            client = receiver.client_f()
+            out = []
+            for selector in selectors:
+                if not hasattr(client, 'query'):
+                    rows = receiver.store.select(selector, 1000 * t1, 1000 * t2)
+                    if rows is None:
+                        self.send_error(503, "the window is not in the local store")
+                        return
+                    source = 'local'
+                else:
+                    (source, rows) = receiver.store.select_or_fetch(client, selector, t1, t2)
+                for (labels, samples) in rows:
+                    out.append({
+                        "selector": inspect_prom.selector_text(selector),
+                        "source": source,
+                        "labels": labels,
+                        "samples": samples
+                    })
+            body = json.dumps(out).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, fmt, *args)
+    return Handler
+
+#############################################################################
+
+def serve(args, client_f):
+    receiver = Receiver(client_f, args)
+    receiver.start()
+    server = ThreadingHTTPServer((args.listen, args.listen_port), make_handler(receiver, args.verbose))
+    print("listening on http://%s:%d%s (snappy: %s)" % (args.listen, server.server_address[1], WRITE_PATH,
+        "python-snappy" if snappy else "builtin"))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return receiver, server
+
+
+def run(args, creds):
+    if args.stand_in:
+        stand_in = StandIn(args.stand_in_fail_rate)
+        client_f = lambda: stand_in
+    else:
+        r = create_clients(args.test, creds)
+        if r is None:
+            raise ValueError("unknown test scenario: %d" % args.test)
+        (user, _, attrs) = r
+        client_f = client_pool(user)
+    (receiver, server) = serve(args, client_f)
+    try:
+        while True:
+            time.sleep(args.stats)
+            print(json.dumps(dict(receiver.stats), sort_keys=True))
+            if receiver.store:
+                receiver.store.expire()
+                print(json.dumps(dict(receiver.store.size(), **receiver.store.stats), sort_keys=True))
+    except KeyboardInterrupt:
+        server.shutdown()
+        receiver.flush()
+        print(json.dumps(dict(receiver.stats), sort_keys=True))
+
+
+def selftest(args):
+    stand_in = StandIn(args.stand_in_fail_rate)
+    args.listen, args.listen_port = '127.0.0.1', 0
+    (receiver, server) = serve(args, lambda: stand_in)
+    url = "http://127.0.0.1:%d%s" % (server.server_address[1], WRITE_PATH)
+    ms0 = time.time()
+    t_ms = (int(ms0) + 1) * 1000
+    sent = 0
+    for i in range(args.selftest_requests):
+        series = []
+        for j in range(args.selftest_series):
+            labels = {'__name__': 'node_cpu_seconds_total', 'instance': 'host%d:9100' % j, 'cpu': str(j % 8), 'mode': 'user'}
+            series.append((labels, [(t_ms + 1000 * i, random.randint(0, 10000) / 10.0)]))
+        body = snappy_compress(encode_write_request(series))
+        assert decode_write_request(snappy_uncompress(body)) == series
+        req = urllib.request.Request(url, data=body, headers={
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'X-Prometheus-Remote-Write-Version': '0.1.0'})
+        with urllib.request.urlopen(req) as resp:
+            assert resp.status == 204, resp.status
+        sent += len(series)
+    receiver.flush()
+    if receiver.store:
+        query = urllib.parse.urlencode({'select': '__name__="node_cpu_seconds_total"',
+            'from': t_ms // 1000, 'to': t_ms // 1000 + args.selftest_requests})
+        with urllib.request.urlopen("http://127.0.0.1:%d%s?%s" % (server.server_address[1], SELECT_PATH, query)) as resp:
+            rows = json.loads(resp.read().decode('utf-8'))
+        assert sum([len(r['samples']) for r in rows]) == sent, rows[:1]
+        print("OK: %d samples of %d series are read from the local store" % (sent, len(rows)))
+    server.shutdown()
+    if args.verbose:
+        print(json.dumps(dict(receiver.stats), sort_keys=True))
+    assert stand_in.records == sent, (stand_in.records, sent)
+    print("OK: %d samples in %d requests are forwarded in %d inserts, elapsed: %ss" % (
+        sent, args.selftest_requests, stand_in.inserts, round((time.time() - ms0) * 1000) / 1000.0))
+
+
+def main(args):
+    try:
+        if args.selftest:
+            selftest(args)
+        else:
+            run(args, open_creds(args, CREDS))
+    except ConnectionError as e:
+        print(e)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prometheus remote-write receiver for TimeEngine')
+    parser.add_argument('-s','--server', help='TimeEngine server host', required=False)
+    parser.add_argument('-p','--port', help='TimeEngine server port', required=False)
+    parser.add_argument('--use_https', help='Use https scheme', required=False, default=False, action='store_true')
+    parser.add_argument('-t', '--test', type=int, choices=range(1, 101), help='test scenario number (see prom.py)', default=1)
+    parser.add_argument('--creds', help="file with credential info", required=False)
+    parser.add_argument('--listen', help='Listen address', required=False, default='0.0.0.0')
+    parser.add_argument('--listen_port', type=int, help='Listen port', required=False, default=9201)
+    parser.add_argument('--batch', type=int, help='Max number of samples in an insert', required=False, default=10000)
+    parser.add_argument('--flush', type=float, help='Max seconds to hold samples before an insert', required=False, default=1.0)
+    parser.add_argument('--queue', type=int, help='Max number of queued WriteRequests (then 503)', required=False, default=1000)
+    parser.add_argument('--forwarders', type=int, help='Number of concurrent inserts', required=False, default=4)
+    parser.add_argument('--retries', type=int, help='Number of retries of a failed insert', required=False, default=5)
+    parser.add_argument('--stats', type=int, help='Print stats every given number of seconds', required=False, default=60)
+    parser.add_argument('--store_retention', type=int, help='Keep received samples locally for the given number of seconds (0 - no local store)', required=False, default=0)
+    parser.add_argument('--stand_in', help='Forward to a local stand-in for TimeEngine', required=False, action='store_true')
+    parser.add_argument('--stand_in_fail_rate', type=float, help='Stand-in: share of failed inserts', required=False, default=0.0)
+    parser.add_argument('--selftest', help='Post generated WriteRequests to a receiver with a stand-in', required=False, action='store_true')
+    parser.add_argument('--selftest_requests', type=int, help='Self-test: number of WriteRequests', required=False, default=100)
+    parser.add_argument('--selftest_series', type=int, help='Self-test: number of series in a WriteRequest', required=False, default=500)
+    parser.add_argument('--verbose', help='verbose: True or False', required=False, action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.server != None:
+        utils.HOST = args.server
+    if args.port != None:
+        utils.PORT = int(args.port)
+    if args.use_https != None:
+        utils.ISHTTPS = args.use_https
+
+    main(args)
+
+#############################################################################
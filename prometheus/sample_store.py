@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+#
+# sample_store.py - in-process ring-buffer store of recent Prometheus samples
+#
+# Every series has a fixed-size head of NumPy arrays (timestamps in ms, values);
+# a full head is sealed into a Gorilla-compressed block (delta-of-delta
+# timestamps, XOR-ed values) and the head arrays are reused. Blocks older than
+# the retention are dropped. A select of a window that started after the store
+# did and is within the retention is answered locally, others go to TimeEngine.
+#
+
+from __future__ import print_function
+import struct, re, time, threading, collections
+
+import inspect_prom
+
+RETENTION = 3 * 3600
+BLOCK_SAMPLES = 120
+
+#############################################################################
+# Gorilla compression
+
+class BitWriter(object):
+    def __init__(self):
+        self.value = 0
+        self.n = 0
+
+    def write(self, bits, n):
+        self.value = (self.value << n) | (bits & ((1 << n) - 1))
+        self.n += n
+
+    def to_bytes(self):
+        pad = -self.n % 8
+        return (self.value << pad).to_bytes((self.n + pad) // 8, 'big')
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.total = 8 * len(data)
+        self.pos = 0
+
+    def read(self, n):
+        self.pos += n
+        return (self.value >> (self.total - self.pos)) & ((1 << n) - 1)
+
+
+# delta-of-delta buckets: (prefix, prefix bits, value bits)
+DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 64)]
+
+def float_bits(v):
+    return struct.unpack('>Q', struct.pack('>d', v))[0]
+
+def bits_float(b):
+    return struct.unpack('>d', struct.pack('>Q', b))[0]
+
+def signed(b, n):
+    return b - (1 << n) if b >= (1 << (n - 1)) else b
+
+def encode_block(ts, vs):
+    w = BitWriter()
+    w.write(ts[0], 64)
+    w.write(float_bits(vs[0]), 64)
+    (delta, prev_t, prev_v) = (0, ts[0], float_bits(vs[0]))
+    (leading, trailing) = (65, 0)
+    for i in range(1, len(ts)):
+        dod = (ts[i] - prev_t) - delta
+        delta = ts[i] - prev_t
+        prev_t = ts[i]
+        if dod == 0:
+            w.write(0, 1)
+        else:
+            for (prefix, prefix_bits, n) in DOD_BUCKETS:
+                if n == 64 or -(1 << (n - 1)) <= dod < (1 << (n - 1)):
+                    w.write(prefix, prefix_bits)
+                    w.write(dod, n)
+                    break
+        v = float_bits(vs[i])
+        x = v ^ prev_v
+        prev_v = v
+        if x == 0:
+            w.write(0, 1)
+            continue
+        w.write(1, 1)
+        lz = min(31, 64 - x.bit_length())
+        tz = (x & -x).bit_length() - 1
+        if leading <= lz and trailing <= tz:
+            w.write(0, 1)
+            w.write(x >> trailing, 64 - leading - trailing)
+        else:
+            (leading, trailing) = (lz, tz)
+            w.write(1, 1)
+            w.write(leading, 5)
+            w.write(64 - leading - trailing - 1, 6)
+            w.write(x >> trailing, 64 - leading - trailing)
+    return w.to_bytes()
+
+def decode_block(data, count):
+    r = BitReader(data)
+    ts = [r.read(64)]
+    v = r.read(64)
+    vs = [bits_float(v)]
+    (delta, leading, trailing) = (0, 0, 0)
+    for _ in range(1, count):
+        if r.read(1) == 0:
+            dod = 0
+        else:
+            for (prefix, prefix_bits, n) in DOD_BUCKETS[:-1]:
+                if r.read(1) == 0:
+                    break
+            else:
+                n = DOD_BUCKETS[-1][2]
+            dod = signed(r.read(n), n)
+        delta += dod
+        ts.append(ts[-1] + delta)
+        if r.read(1) == 1:
+            if r.read(1) == 1:
+                leading = r.read(5)
+                trailing = 64 - leading - (r.read(6) + 1)
+            v ^= r.read(64 - leading - trailing) << trailing
+        vs.append(bits_float(v))
+    return ts, vs
+
+#############################################################################
+# Store
+
+def matches(labels, selector):
+    # Prometheus semantics: a missing label has the value ""
+    (label, value, rule) = selector
+    actual = labels.get(label, "")
+    if rule == 'EQ':
+        return actual == value
+    if rule == 'NEQ':
+        return actual != value
+    found = re.fullmatch(value, actual) is not None
+    return found if rule == 'RE' else not found
+
+
+class Series(object):
+    def __init__(self, np, labels, block_samples):
+        self.labels = labels
+        self.t = np.zeros(block_samples, dtype=np.int64)
+        self.v = np.zeros(block_samples, dtype=np.float64)
+        self.n = 0
+        self.blocks = collections.deque() # (t_first, t_last, count, data)
+
+    def last_t(self):
+        if self.n:
+            return int(self.t[self.n - 1])
+        return self.blocks[-1][1] if self.blocks else None
+
+    def add(self, t, v):
+        self.t[self.n] = t
+        self.v[self.n] = v
+        self.n += 1
+        if self.n == len(self.t):
+            self.blocks.append((int(self.t[0]), t, self.n, encode_block(self.t.tolist(), self.v.tolist())))
+            self.n = 0
+
+    def expire(self, t_ms):
+        while self.blocks and self.blocks[0][1] < t_ms:
+            self.blocks.popleft()
+
+    def samples(self, t1, t2):
+        out = []
+        for (first, last, count, data) in self.blocks:
+            if last >= t1 and first < t2:
+                (ts, vs) = decode_block(data, count)
+                out.extend([[t, v] for (t, v) in zip(ts, vs) if t1 <= t < t2])
+        if self.n:
+            (ts, vs) = (self.t[:self.n], self.v[:self.n])
+            mask = (ts >= t1) & (ts < t2)
+            out.extend([[t, v] for (t, v) in zip(ts[mask].tolist(), vs[mask].tolist())])
+        return out
+
+
+class SampleStore(object):
+    def __init__(self, retention = RETENTION, block_samples = BLOCK_SAMPLES):
+        import numpy
+        self.np = numpy
+        self.retention_ms = 1000 * retention
+        self.block_samples = block_samples
+        self.since_ms = int(time.time() * 1000)
+        self.series = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def add(self, labels, t_ms, value):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series(self.np, dict(labels), self.block_samples)
+            last = series.last_t()
+            if last is not None and t_ms <= last:
+                self.stats['out_of_order'] += 1
+                return
+            series.add(t_ms, value)
+            self.stats['samples'] += 1
+
+    def expire(self, now_ms = None):
+        t = (now_ms or int(time.time() * 1000)) - self.retention_ms
+        with self.lock:
+            for key, series in list(self.series.items()):
+                series.expire(t)
+                last = series.last_t()
+                if last is None or last < t:
+                    del self.series[key]
+
+    def covers(self, t1_ms):
+        return t1_ms >= max(self.since_ms, int(time.time() * 1000) - self.retention_ms)
+
+    def select(self, selector, t1_ms, t2_ms):
+        # [(labels, [[t_ms, value]])] of non-empty series, or None if the window is not covered
+        if not self.covers(t1_ms):
+            return None
+        with self.lock:
+            found = [s for s in self.series.values() if matches(s.labels, selector)]
+            rows = [(s.labels, s.samples(t1_ms, t2_ms)) for s in found]
+        return [(labels, samples) for (labels, samples) in rows if samples]
+
+    def select_or_fetch(self, client, selector, t1, t2):
+        # (source, rows) for [t1, t2) seconds: local if covered, otherwise read from TimeEngine
+        rows = self.select(selector, 1000 * t1, 1000 * t2)
+        if rows is not None:
+            self.stats['local_reads'] += 1
+            return ('local', rows)
+        self.stats['server_reads'] += 1
+        return ('server', inspect_prom.fetch_chunk(lambda: client, selector, t1, t2))
+
+    def size(self):
+        with self.lock:
+            blocks = sum([len(s.blocks) for s in self.series.values()])
+            compressed = sum([len(b[3]) for s in self.series.values() for b in s.blocks])
+        return {'series': len(self.series), 'blocks': blocks, 'compressed_bytes': compressed}
+
+#############################################################################
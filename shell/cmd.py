@@ -5,23 +5,26 @@
 
 from __future__ import print_function
 
-import argparse, os, sys, json, random, time, re
+import time
+STARTUP_T0 = time.time()
 
-import pprint
-pp = pprint.PrettyPrinter()
-
-from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import WordCompleter
-from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.styles import Style
+import argparse, os, sys, json, random, re, collections, stat
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 
-from mdtsdb import Mdtsdb
-import utils
-from utils import (new_user, ConnectionError, create_clients, update_clients, open_creds, REQ_TIMEOUT)
+# prompt_toolkit, pprint and the TimeEngine client (mdtsdb, utils) are imported
+# on first use: see load_client(), pprint_result() and the interactive loop
 
 CONFIG = 'shell.json'
+DATA_BATCH = 10000
+DATA_WORKERS = 4
+SOURCE_WORKERS = 4
+BENCH_N = 10
+CACHE_ENTRIES = 256
+CACHE_MB = 64
+CACHE_RECENT_FRACTION = 0.01
+DAEMON_WORKERS = 4
+BATCH_CONCURRENCY = 8
 
 #############################################################################
 
@@ -31,19 +34,120 @@ shell_commands = {
     "help":   shell_command_sign + "help",
     "exit":   shell_command_sign + "exit",
     "source": shell_command_sign + "source",
+    "bench":  shell_command_sign + "bench",
     "data":   shell_command_sign + "data",
+    "load":   shell_command_sign + "load",
     "j":      shell_command_sign + "j",
-    "whoami": shell_command_sign + "whoami"
+    "whoami": shell_command_sign + "whoami",
+    "cache":  shell_command_sign + "cache"
 }
 shell_commands_help = {
     "help":   "  !help                    Print help about TimeEngine shell.",
     "exit":   "  !exit or !q              Exit from TimeEngine shell.",
-    "source": "  !source 'path to script' Execute a script file.",
-    "data":   "  !data 'path to json'     Export data from json file and send to TimeEngine.",
+    "source": "  !source 'path to script' Execute a script file. Several files and directories (all files in a directory)\n"
+              "         [workers=K]       are executed concurrently in K connections (default: %d) with per-script timing." % SOURCE_WORKERS,
+    "bench":  "  !bench [n=N] [clients=K] code\n"
+              "                           Execute code N times in K concurrent connections (default: %d, 1), print latencies." % BENCH_N,
+    "data":   "  !data 'path to json'     Export data from json file and send to TimeEngine. The file is either a JSON list\n"
+              "         [batch=N]         of insert payloads, or NDJSON (a payload per line); it is read incrementally and\n"
+              "         [workers=K]       sent by N data records in K concurrent requests (default: %d, %d)." % (DATA_BATCH, DATA_WORKERS),
+    "load":   "  !load 'path' opts        Bulk load a Parquet/Arrow/NPY file, opts: measurement=M [ns=C] [value=C]\n"
+              "                           [series=C1,C2] [batch=N] (by columns) or key=SWIMLANE (by sensor columns).",
     "j":      "  !j code                  Execute code and pretty-print result as JSON.",
-    "whoami": "  !whoami                  Print the name of the current User."
+    "whoami": "  !whoami                  Print the name of the current User (connects if not connected yet).",
+    "cache":  "  !cache on|off|stats|clear\n"
+              "                           Turn on/off the cache of read-only query results, print its stats or clear it."
 }
 
+#############################################################################
+# Query result cache
+#
+# Results of read-only queries are kept in LRU order, limited by the number of
+# entries and by the size of the JSON-encoded results. Queries that may change
+# data (or depend on now()) are never cached and drop the cached results of
+# their User. A result of a 'recent "<window>"' query expires after a fraction
+# of the window.
+
+MUTATION_RE = re.compile(r"\b(insert|delete\w*|create\w*|new_\w*|update\w*|set_\w*|grant|revoke|env|task|write|send_metrics?|kafka|now)\b")
+RECENT_RE = re.compile(r'\brecent\s+"(\d+)([smhdw]?)"', re.I)
+STRING_RE = re.compile(r'("(?:[^"\\]|\\.)*")')
+# strings and % comments, matched left to right so that a quote in a comment
+# and a % in a string are not taken for the other
+STRING_OR_COMMENT_RE = re.compile(r'"(?:[^"\\]|\\.)*"|%[^\n]*')
+TIME_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+class QueryCache(object):
+    def __init__(self, max_entries = CACHE_ENTRIES, max_mb = CACHE_MB, ttl = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.bypassed = self.evictions = 0
+
+    @staticmethod
+    def normalize(qtext):
+        parts = STRING_RE.split(qtext.strip())
+        return ''.join([part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)])
+
+    @staticmethod
+    def code(qtext):
+        return ''.join(STRING_RE.split(qtext)[::2])
+
+    def expires(self, qtext):
+        windows = [int(n) * TIME_UNITS[unit.lower()] for (n, unit) in RECENT_RE.findall(qtext)]
+        ttl = [w * CACHE_RECENT_FRACTION for w in windows] + ([self.ttl] if self.ttl else [])
+        return time.time() + min(ttl) if ttl else None
+
+    def query(self, client, qtext):
+        user = client.admin_key or getattr(client, 'app_key', None)
+        if MUTATION_RE.search(self.code(qtext)):
+            self.bypassed += 1
+            self.drop_user(user)
+            return client.query(qtext)
+        key = (user, self.normalize(qtext))
+        entry = self.entries.get(key)
+        if entry is not None and (entry[2] is None or entry[2] > time.time()):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return ('ok', entry[0])
+        self.misses += 1
+        (ok, result) = client.query(qtext)
+        if ok == 'ok':
+            self.put(key, result, self.expires(qtext))
+        return (ok, result)
+
+    def put(self, key, result, expires):
+        self.pop(key)
+        size = len(json.dumps(result))
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (result, size, expires)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.pop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def drop_user(self, user):
+        for key in [key for key in self.entries if key[0] == user]:
+            self.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return "entries: %d/%d, size: %.1f/%d MB, hits: %d, misses: %d, not cached: %d, evictions: %d" % (
+            len(self.entries), self.max_entries, self.bytes / 1024.0 / 1024.0, self.max_bytes // (1024 * 1024),
+            self.hits, self.misses, self.bypassed, self.evictions)
+
+query_cache = None
+
 #############################################################################
 
 def config_path(args, filename):
@@ -74,13 +178,31 @@ def write_config(args, info):
         json.dump(data, outfile, indent=4)
         return ("ok", "")
 
+def load_client(args):
+    global Mdtsdb, utils, columnar, ConnectionError
+    from mdtsdb import Mdtsdb
+    import utils, columnar
+    from utils import ConnectionError
+
+    if args.server != None:
+        utils.HOST = args.server
+    if args.port != None:
+        utils.PORT = int(args.port)
+    if args.use_https != None:
+        utils.ISHTTPS = args.use_https
+
+    if args.key != None:
+        utils.MasterKey = args.key
+    if args.secret != None:
+        utils.MasterSecret = args.secret
+
 def get_su(args):
     return Mdtsdb(
         host=utils.HOST,
         port=utils.PORT,
         admin_key=utils.MasterKey,
         secret_key=utils.MasterSecret,
-        timeout=REQ_TIMEOUT,
+        timeout=utils.REQ_TIMEOUT,
         is_https=utils.ISHTTPS)
 
 def create_user(args, su):
@@ -93,7 +215,7 @@ def create_user(args, su):
             port=utils.PORT,
             admin_key=args.user_key,
             secret_key=args.user_secret,
-            timeout=REQ_TIMEOUT,
+            timeout=utils.REQ_TIMEOUT,
             is_https=utils.ISHTTPS)
         write_config(args, {"key": args.user_key, "secret_key": args.user_secret})
         return user
@@ -103,27 +225,95 @@ def create_user(args, su):
             port=utils.PORT,
             admin_key=result["key"],
             secret_key=result["secret_key"],
-            timeout=REQ_TIMEOUT,
+            timeout=utils.REQ_TIMEOUT,
             is_https=utils.ISHTTPS)
     else:
         print("fatal error: require either config file, or user credentials")
         raise(EOFError)
 
-def run_query(args, active_user, qtext, as_json):
-    (ok, result) = active_user.query(qtext)
+active_user = None
+
+def get_active_user(args):
+    global active_user
+    if active_user is None:
+        load_client(args)
+        ms0 = time.time()
+        # stdout is reserved for results in the batch mode
+        log = sys.stderr if args.batch != None else sys.stdout
+        print("connecting to %s:%s ..." % (str(utils.HOST), str(utils.PORT)), file=log)
+        # creating a super-user
+        super_user = get_su(args)
+        # creating a User
+        active_user = create_user(args, super_user)
+        print("connected as %s (%d ms) ..." % (str(active_user.admin_key), (time.time() - ms0) * 1000), file=log)
+    return active_user
+
+def pprint_result(result, as_json = False):
+    import pprint
     if as_json:
-        pp.pprint(json.dumps(result, indent=4, sort_keys=True))
+        pprint.pprint(json.dumps(result, indent=4, sort_keys=True))
+    else:
+        pprint.pprint(result)
+
+def run_query(args, active_user, qtext, as_json):
+    if query_cache:
+        (ok, result) = query_cache.query(active_user, qtext)
     else:
-        pp.pprint(result)
+        (ok, result) = active_user.query(qtext)
+    pprint_result(result, as_json)
     return True
 
+def timed_query(client, qtext):
+    ms0 = time.time()
+    (ok, result) = client.query(qtext)
+    return (ok, result, (time.time() - ms0) * 1000)
+
+def split_opts(parts, names):
+    opts, rest = {}, []
+    for part in parts:
+        m = re.match("^(%s)=(\\d+)$" % '|'.join(names), part)
+        if m:
+            opts[m.group(1)] = int(m.group(2))
+        else:
+            rest.append(part)
+    return (opts, rest)
+
+def source_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([os.path.join(path, fn) for fn in os.listdir(path) if os.path.isfile(os.path.join(path, fn))]))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError("No such file or directory: %s" % path)
+    return files
+
 def run_source(args, active_user, qtext):
-    parts = qtext.split()
+    (opts, paths) = split_opts(qtext.split()[1:], ["workers"])
     try:
-        with open(parts[1]) as script:
-            run_query(args, active_user, script.read(), False)
+        files = source_files(paths)
+        if len(files) == 0:
+            raise IndexError
+        elif len(files) == 1 and not os.path.isdir(paths[0]):
+            with open(files[0]) as script:
+                ms0 = time.time()
+                run_query(args, active_user, script.read(), False)
+                print("  elapsed: %d ms" % ((time.time() - ms0) * 1000))
+        else:
+            pool = utils.client_pool(active_user)
+            def run(fn):
+                with open(fn) as script:
+                    return (fn,) + timed_query(pool(), script.read())
+            ms0 = time.time()
+            latencies = []
+            for (fn, ok, result, elapsed) in utils.imap_concurrently(run, files, opts.get("workers", SOURCE_WORKERS)):
+                print("*** %s: %s, %d ms" % (fn, ok, elapsed))
+                pprint_result(result)
+                latencies.append(elapsed)
+            print("  %d scripts, elapsed: %d ms (%s)" % (len(files), (time.time() - ms0) * 1000, utils.latency_report(latencies)))
     except FileNotFoundError as e:
-        print(str(e) + ": " + parts[1])
+        print(str(e))
         return False
     except IndexError:
         print("  Unexpected command format, should be:")
@@ -131,23 +321,107 @@ def run_source(args, active_user, qtext):
         return False
     return True
 
+def run_bench(args, active_user, qtext):
+    m = re.match("^!bench((?:\\s+(?:n|clients)=\\d+)*)\\s+(.+)$", qtext, re.S)
+    if not m:
+        print("  Unexpected command format, should be:")
+        print(shell_commands_help["bench"])
+        return False
+    (opts, _) = split_opts(m.group(1).split(), ["n", "clients"])
+    n, clients = opts.get("n", BENCH_N), opts.get("clients", 1)
+    pool = utils.client_pool(active_user)
+    def run(_):
+        (ok, _, elapsed) = timed_query(pool(), m.group(2))
+        return (ok, elapsed)
+    ms0 = time.time()
+    latencies, errors = [], 0
+    for (ok, elapsed) in utils.imap_concurrently(run, range(n), clients):
+        latencies.append(elapsed)
+        if ok != 'ok':
+            errors += 1
+    wall = time.time() - ms0
+    print("  %s" % utils.latency_report(latencies))
+    print("  queries: %d, errors: %d, clients: %d, elapsed: %d ms, %.1f queries/s" % (n, errors, clients, wall * 1000, n / wall if wall > 0 else 0))
+    return errors == 0
+
 def run_data(args, active_user, qtext):
     parts = qtext.split()
     try:
-        with open(parts[1]) as json_file:
-            multi_payload = json.load(json_file)
-            (status, result) = active_user.insert(multi_payload)
+        opts = dict([opt.split('=', 1) for opt in parts[2:]])
+        batch = int(opts.get('batch', DATA_BATCH))
+        workers = int(opts.get('workers', DATA_WORKERS))
+        pool = utils.client_pool(active_user)
+        def insert(payload):
+            (status, result) = pool().insert(payload)
             assert status == 'ok', (status, result)
-            print(result)
+            return sum([len(p['data']) for p in payload])
+        ms0 = time.time()
+        total = 0
+        with open(parts[1]) as json_file:
+            batches = utils.insert_batches(utils.iter_json_values(json_file), batch)
+            for n in utils.imap_concurrently(insert, batches, workers):
+                total += n
+                elapsed = time.time() - ms0
+                print("\r  sent %d records, %d records/s" % (total, total / elapsed if elapsed > 0 else 0), end='')
+        print("\n  done, elapsed: %ss" % (round((time.time() - ms0) * 1000) / 1000.0))
     except FileNotFoundError as e:
         print(str(e) + ": " + parts[1])
         return False
+    except ValueError as e:
+        print(str(e))
+        return False
     except IndexError as e:
         print("  Unexpected command format, should be:")
         print(shell_commands_help["data"])
         return False
     return True
 
+def run_load(args, active_user, qtext):
+    parts = qtext.split()
+    try:
+        path = parts[1]
+        opts = dict([opt.split('=', 1) for opt in parts[2:]])
+        if 'key' in opts:
+            payload_f = lambda cols: columnar.swimlane_payload(cols, opts['key'], opts.get('ns', 'ns'))
+        else:
+            series_cols = opts['series'].split(',') if opts.get('series') else []
+            payload_f = lambda cols: columnar.measurement_payload(
+                cols, opts['measurement'], opts.get('ns', 'ns'), opts.get('value', 'value'), series_cols)
+        ms0 = time.time()
+        total = columnar.load_file(active_user, path, payload_f, None, int(opts.get('batch', columnar.LOAD_BATCH)), True)
+        print("loaded %d records, elapsed: %ss" % (total, round((time.time() - ms0) * 1000) / 1000.0))
+    except (FileNotFoundError, ValueError) as e:
+        print(str(e))
+        return False
+    except (IndexError, KeyError):
+        print("  Unexpected command format, should be:")
+        print(shell_commands_help["load"])
+        return False
+    return True
+
+def run_cache(args, qtext):
+    global query_cache
+    parts = qtext.split()
+    cmd = parts[1] if len(parts) == 2 else None
+    if cmd == "on":
+        if not query_cache:
+            query_cache = QueryCache(args.cache_size, args.cache_mb, args.cache_ttl)
+        print("  query cache is on")
+    elif cmd == "off":
+        query_cache = None
+        print("  query cache is off")
+    elif cmd == "stats":
+        print("  %s" % (query_cache.stats() if query_cache else "query cache is off"))
+    elif cmd == "clear":
+        if query_cache:
+            query_cache.clear()
+        print("  query cache is cleared")
+    else:
+        print("  Unexpected command format, should be:")
+        print(shell_commands_help["cache"])
+        return False
+    return True
+
 def run_help(args, qtext):
     parts = qtext.split()
     if len(parts) == 1:
@@ -161,6 +435,179 @@ def run_help(args, qtext):
         return False
     return True
 
+def run_command(args, qtext):
+    if qtext == "":
+        pass
+    elif re.match("^!(help|h)( |$)", qtext):
+        run_help(args, qtext)
+    elif qtext == "!whoami" or qtext == "!w":
+        print("connected as: %s" % str(get_active_user(args).admin_key))
+    elif re.match("^!cache( |$)", qtext):
+        run_cache(args, qtext)
+    elif re.match("^!source( |$)", qtext):
+        run_source(args, get_active_user(args), qtext)
+    elif re.match("^!bench( |$)", qtext):
+        run_bench(args, get_active_user(args), qtext)
+    elif re.match("^!data( |$)", qtext):
+        run_data(args, get_active_user(args), qtext)
+    elif re.match("^!load( |$)", qtext):
+        run_load(args, get_active_user(args), qtext)
+    elif qtext == "!exit" or qtext == "!q":
+        return False
+    elif re.match("^!j ", qtext):
+        run_query(args, get_active_user(args), qtext[3:], True)
+    else:
+        run_query(args, get_active_user(args), qtext, False)
+    return True
+
+#############################################################################
+# Daemon: a warm process with open connections serves "cmd.py -e" invocations
+# over a Unix socket, a JSON request/response per line.
+
+def socket_dir():
+    # a private (0700) per-user directory: another user can neither create the
+    # socket first nor connect to it
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "mdtsdb")
+    path = os.path.join(base, "te-shell")
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError("unsafe socket directory: %s" % path)
+    return path
+
+def socket_path(args):
+    if args.socket != None:
+        return args.socket
+    return os.path.join(socket_dir(), "te-shell.sock")
+
+def socket_owned(path):
+    # a socket created by this user
+    st = os.lstat(path)
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+def socket_alive(path):
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+def run_daemon(args):
+    import socketserver, queue
+    user = get_active_user(args)
+    clients = queue.Queue()
+    for _ in range(args.daemon_workers):
+        clients.put(utils.clone_client(user))
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                client = clients.get()
+                try:
+                    (ok, result) = client.query(json.loads(line)["q"])
+                except Exception as e:
+                    (ok, result) = ("error", repr(e))
+                finally:
+                    clients.put(client)
+                self.wfile.write((json.dumps({"ok": ok, "result": result}) + "\n").encode())
+
+    path = socket_path(args)
+    if os.path.exists(path):
+        if socket_alive(path):
+            print("a daemon is already serving on %s" % path)
+            return
+        if not socket_owned(path):
+            print("not a socket of this user: %s" % path)
+            return
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    os.chmod(path, 0o600)
+    print("serving on %s, started in %d ms ..." % (path, (time.time() - STARTUP_T0) * 1000))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def daemon_query(args, qtext):
+    import socket
+    path = socket_path(args)
+    if not socket_owned(path):
+        raise OSError("not a socket of this user: %s" % path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        with s.makefile("rwb") as f:
+            f.write((json.dumps({"q": qtext}) + "\n").encode())
+            f.flush()
+            r = json.loads(f.readline())
+    return (r["ok"], r["result"])
+
+def run_execute(args, qtext):
+    as_json = re.match("^!j ", qtext) is not None
+    if as_json:
+        qtext = qtext[3:]
+    elif qtext.startswith("!"):
+        return run_command(args, qtext)
+    try:
+        (ok, result) = daemon_query(args, qtext)
+    except (OSError, ValueError):
+        # no daemon: run in this process
+        (ok, result) = get_active_user(args).query(qtext)
+    pprint_result(result, as_json)
+    if args.startup_time:
+        print("elapsed: %d ms" % ((time.time() - STARTUP_T0) * 1000))
+    return ok == "ok"
+
+#############################################################################
+# Batch mode: statements from a file or stdin are executed over a pool of
+# connections; results are written as NDJSON in the input order. A statement
+# ends with a line ending with "." (chain expressions with "," to send them
+# as one statement, e.g. 'use("key"), select ... end.').
+
+def statement_complete(text):
+    code = STRING_OR_COMMENT_RE.sub('', text)
+    return '"' not in code and code.rstrip().endswith('.')
+
+def iter_statements(fd):
+    lines = []
+    for line in fd:
+        if not lines and line.strip() == "":
+            continue
+        lines.append(line)
+        text = ''.join(lines)
+        if statement_complete(text):
+            yield text.strip()
+            lines = []
+    if ''.join(lines).strip():
+        yield ''.join(lines).strip()
+
+def run_batch(args):
+    user = get_active_user(args)
+    pool = utils.client_pool(user)
+    def run(item):
+        (no, qtext) = item
+        try:
+            (ok, result, elapsed) = timed_query(pool(), qtext)
+        except Exception as e:
+            (ok, result, elapsed) = ("error", repr(e), 0)
+        return {"n": no, "ok": ok, "ms": round(elapsed, 1), "result": result}
+    fd = sys.stdin if args.batch == "-" else open(args.batch)
+    errors = 0
+    try:
+        for r in utils.imap_concurrently(run, enumerate(iter_statements(fd)), args.concurrency):
+            print(json.dumps(r))
+            if r["ok"] != "ok":
+                errors += 1
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+    return errors == 0
+
 #############################################################################
 
 if __name__ == "__main__":
@@ -176,20 +623,42 @@ if __name__ == "__main__":
     parser.add_argument('--builtin', help='Run in builtin user mode', required=False, action='store_true')
     parser.add_argument('--multiline', help='Run in multi-line mode (Enter - a new line, Meta+Enter - execute)',
                         required=False, action='store_true')
+    parser.add_argument('--cache', help='Cache results of read-only queries', required=False, action='store_true')
+    parser.add_argument('--cache_size', help='Query cache: max number of results', required=False, type=int, default=CACHE_ENTRIES)
+    parser.add_argument('--cache_mb', help='Query cache: max size of results in MB', required=False, type=int, default=CACHE_MB)
+    parser.add_argument('--cache_ttl', help='Query cache: expire results in the given number of seconds (0 - never)',
+                        required=False, type=int, default=0)
+    parser.add_argument('-e', '--execute', help='Execute code (via a running daemon if any) and exit', required=False)
+    parser.add_argument('--daemon', help='Run as a daemon serving "-e" invocations', required=False, action='store_true')
+    parser.add_argument('--daemon_workers', help='Daemon: number of connections', required=False, type=int, default=DAEMON_WORKERS)
+    parser.add_argument('--socket', help='Daemon: Unix socket path', required=False)
+    parser.add_argument('--batch', help='Execute statements from the file (- for stdin), print results as NDJSON and exit',
+                        required=False)
+    parser.add_argument('--concurrency', help='Batch mode: number of concurrent connections', required=False, type=int,
+                        default=BATCH_CONCURRENCY)
+    parser.add_argument('--startup_time', help='Print the time spent from start to the first prompt or result',
+                        required=False, action='store_true')
 
     args = parser.parse_args()
 
-    if args.server != None:
-        utils.HOST = args.server
-    if args.port != None:
-        utils.PORT = int(args.port)
-    if args.use_https != None:
-        utils.ISHTTPS = args.use_https
+    if args.cache:
+        query_cache = QueryCache(args.cache_size, args.cache_mb, args.cache_ttl)
 
-    if args.key != None:
-        utils.MasterKey = args.key
-    if args.secret != None:
-        utils.MasterSecret = args.secret
+    if args.daemon:
+        run_daemon(args)
+        sys.exit(0)
+    elif args.batch != None:
+        try:
+            sys.exit(0 if run_batch(args) else 1)
+        except (ConnectionError, EOFError) as e:
+            print(repr(e), file=sys.stderr)
+            sys.exit(1)
+    elif args.execute != None:
+        try:
+            sys.exit(0 if run_execute(args, args.execute) else 1)
+        except (ConnectionError, EOFError) as e:
+            print(repr(e))
+            sys.exit(1)
 
     if args.multiline:
         multiline = True
@@ -198,41 +667,18 @@ if __name__ == "__main__":
         multiline = False
 
     try:
-        session = PromptSession(
-#            lexer=PygmentsLexer(SqlLexer), completer=sql_completer, style=style
-        )
-        super_user = None
-        active_user = None
+        from prompt_toolkit import PromptSession
+        session = PromptSession()
+        if args.startup_time:
+            print("started in %d ms" % ((time.time() - STARTUP_T0) * 1000))
         qtext = None
         while True:
             try:
-                if not super_user:
-                    print("connecting to %s:%s ..." % (str(utils.HOST), str(utils.PORT)))
-                    # creating a super-user
-                    super_user = get_su(args)
-                    # creating a User
-                    active_user = create_user(args, super_user)
-                    print("connected as %s ..." % str(active_user.admin_key))
                 qtext = session.prompt(">>> ", multiline=multiline)
-                if qtext == "":
-                    continue
-                elif qtext == "!help" or qtext == "!h":
-                    run_help(args, qtext)
-                elif qtext == "!whoami" or qtext == "!w":
-                    print("connected as: %s" % str(active_user.admin_key))
-                elif qtext == "!source":
-                    run_source(args, active_user, qtext)
-                elif qtext == "!data":
-                    run_data(args, active_user, qtext)
-                elif qtext == "!exit" or qtext == "!q":
+                if not run_command(args, qtext):
                     break
-                elif re.match("^!j ", qtext):
-                    run_query(args, active_user, qtext[3:], True)
-                else:
-                    run_query(args, active_user, qtext, False)
             except ConnectionError as e:
                 print(repr(e))
-                super_user = None
                 active_user = None
             except KeyboardInterrupt:
                 continue  # Control-C pressed. Try again.
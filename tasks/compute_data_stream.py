@@ -3,15 +3,16 @@
 # compute_data_stream.py - server-side stateful computations over a data stream
 #
 
-import argparse, os, sys, csv, json, time, random
+import argparse, os, sys, csv, json, time, random, re, threading, collections
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../common')))
 import utils
 from utils import (new_user, new_swimlane,
-                   write_num, KafkaConsumer,
+                   write_num, KafkaStream,
                    ConnectionError,
                    create_clients, update_clients, open_creds,
-                   clean, print_info)
+                   clean, print_info, latency_report)
+import task_deploy
 
 CREDS = 'compute_data_stream.json'
 TASK = """
@@ -39,6 +40,15 @@ task "detect_anomalies" (
 from [$0]
 end.
 """
+TASKS = ["detect_anomalies"]
+
+# --latency: the values of run k are k * RUN_BASE + a value, injected outliers
+# are k * RUN_BASE + ANOMALY_BASE + their sequence number, so a value in a
+# detect_anomalies message tells which run and write it came from (outliers
+# of the "mad" method do not change with a shift of all values)
+ANOMALY_BASE = 1000000
+RUN_BASE = 10 * ANOMALY_BASE
+OUTLIERS_RE = re.compile(r"Found \d+ outliers \(\[([^\]]*)\]\)")
 
 kafka_consumer = None
 kafka_consumer_wait = 0
@@ -55,9 +65,12 @@ def gen_data(serial_number, i, timestamp, sensor_no):
 
 def init_kafka(args):
     global kafka_consumer, kafka_consumer_wait
-    kafka_consumer = KafkaConsumer(
+    kafka_consumer = KafkaStream(
         args.kafka_server, args.kafka_port, args.kafka_topic,
-        None, args.kafka_init_wait * 1000 + args.kafka_consumer_wait)
+        group_id=args.kafka_group or None, consumers=args.kafka_consumers,
+        max_records=args.kafka_max_records, workers=args.kafka_workers, queue_size=args.kafka_queue,
+        decode=lambda r: r.value.decode('utf-8', 'replace'),
+        wait_ms=args.kafka_init_wait * 1000 + args.kafka_consumer_wait)
     kafka_consumer.start()
     kafka_consumer_wait = args.kafka_consumer_wait
     print("wait Kafka consumer...")
@@ -65,17 +78,167 @@ def init_kafka(args):
 
 
 def read_alarms():
-    kafka_consumer.join(kafka_consumer_wait / 1000.0)
-    msgs = kafka_consumer.msgs
-    msgs_cb = len(msgs)
+    # messages until the consumer waits kafka_consumer_wait ms for the next one
+    msgs_cb = 0
+    for m in kafka_consumer:
+        print(m)
+        msgs_cb += 1
     if msgs_cb > 0:
         print("    there are %d messages from TimeEngine" % msgs_cb)
-        for m in msgs:
-            print(m)
     else:
         print("    no messages")
 
 
+def deploy_main(args, creds):
+    # brings the task of existing test scenarios (all with --all) up to date
+    keys = [key for key in sorted(creds) if key.isdigit()] if args.all else [str(args.test)]
+    targets = []
+    for key in keys:
+        r = create_clients(int(key), creds)
+        if r is None or r[1] is None:
+            print("unknown test scenario: %s" % key)
+            continue
+        targets.append((key, r[1]))
+    return task_deploy.report(task_deploy.deploy_all(
+        targets, lambda swimlane: {"detect_anomalies": TASK}, TASKS, args.deploy_workers, args.dry_run, args.verbose))
+
+
+def task_text(sz):
+    return TASK.replace("sz: 10,", "sz: %d," % sz, 1)
+
+
+class LatencyProbe(object):
+    # write wall times of injected outliers, matched with the Kafka messages
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = []
+        self.seq = 0
+        self.written = {}       # seq -> [run, outlier write time, window close write time]
+        self.latencies = collections.defaultdict(list)
+        self.closed = collections.defaultdict(list)
+        self.injected = collections.Counter()
+        self.false_positives = collections.Counter()
+
+    def start(self, run):
+        # -> the base of the values of the run
+        with self.lock:
+            self.runs.append(run)
+            return len(self.runs) * RUN_BASE
+
+    def inject(self, run):
+        with self.lock:
+            self.seq += 1
+            self.injected[run] += 1
+            self.written[self.seq] = [run, None, None]
+            return self.seq
+
+    def wrote(self, seqs, wall, closing = False):
+        # the points of seqs (closing: the points that close their windows) are written at wall
+        with self.lock:
+            for seq in seqs:
+                if seq in self.written:
+                    self.written[seq][2 if closing else 1] = wall
+
+    def on_message(self, msg):
+        wall = time.time()
+        m = OUTLIERS_RE.search(msg)
+        if m is None:
+            return
+        with self.lock:
+            for v in m.group(1).split(','):
+                try:
+                    x = float(v)
+                except ValueError:
+                    continue
+                k = int(x // RUN_BASE)
+                run = self.runs[k - 1] if 0 < k <= len(self.runs) else None
+                seq = x - k * RUN_BASE - ANOMALY_BASE
+                if seq != int(seq) or int(seq) not in self.written or self.written[int(seq)][1] is None:
+                    self.false_positives[run] += 1
+                    continue
+                (run, t, t_close) = self.written.pop(int(seq))
+                self.latencies[run].append(1000 * (wall - t))
+                if t_close is not None:
+                    self.closed[run].append(1000 * (wall - t_close))
+
+    def report(self, run, fill):
+        with self.lock:
+            (injected, detected) = (self.injected[run], len(self.latencies[run]))
+            return ("%s: injected: %d, detected: %d, loss: %.1f%%, false positives: %d, latency: %s, "
+                    "window fill: %.1f ms, after window close: %s") % (
+                run, injected, detected, 100.0 * (injected - detected) / max(1, injected),
+                self.false_positives[run], latency_report(self.latencies[run]),
+                1000 * fill, latency_report(self.closed[run]))
+
+
+def latency_run(args, swimlane, probe, sz, rate):
+    # rate points (data seconds) per wall second for --latency_duration seconds;
+    # one outlier in the middle of every --anomaly_every-th window, its window
+    # closes with the first point of the next one
+    run = "sz=%d rate=%d" % (sz, rate)
+    base = probe.start(run)
+    task_deploy.deploy(swimlane, {"detect_anomalies": task_text(sz)}, TASKS)
+    n = rate * args.latency_duration
+    ti = (int(time.time()) - n - 2 * sz) // sz * sz
+    tick = 0.1
+    wall0 = time.time()
+    (written, due, pending) = (0, 0.0, [])
+    while written < n:
+        due += rate * tick
+        data, seqs, closing = [], [], []
+        while written < due and written < n:
+            if ti % sz == 0:
+                (closing, pending) = (closing + pending, [])
+            if ti % (sz * args.anomaly_every) == sz // 2:
+                seq = probe.inject(run)
+                seqs.append(seq)
+                pending.append(seq)
+                data.append({'ns': ti, '0': base + ANOMALY_BASE + seq})
+            else:
+                data.append({'ns': ti, '0': base + random.randint(1, 10)})
+            ti += 1
+            written += 1
+        if data:
+            # before the insert: its alerts may come before it returns
+            w = time.time()
+            probe.wrote(seqs, w)
+            probe.wrote(closing, w, closing=True)
+            (ok, r) = swimlane.insert(data)
+            assert ok == 'ok', (ok, r)
+        time.sleep(max(0.0, wall0 + (written / float(rate)) - time.time()))
+    # the last window closes with the next one
+    probe.wrote(pending, time.time(), closing=True)
+    (ok, r) = swimlane.insert([{'ns': ti + sz, '0': base + 1}])
+    assert ok == 'ok', (ok, r)
+    time.sleep(args.latency_drain)
+    # the points after an outlier that fill its window
+    print(probe.report(run, (sz - sz // 2) / float(rate)))
+
+
+def latency_main(args, creds):
+    # ingest -> detect_anomalies -> Kafka latency and loss across window sizes and write rates
+    r = create_clients(args.test, creds)
+    if r is None or r[1] is None:
+        print("test scenario %d does not exist, create it with -w" % args.test)
+        return
+    (user, swimlane, attrs) = r
+    probe = LatencyProbe()
+    stream = KafkaStream(
+        args.kafka_server, args.kafka_port, args.kafka_topic,
+        group_id=args.kafka_group or None, consumers=args.kafka_consumers, max_records=args.kafka_max_records,
+        decode=lambda r: r.value.decode('utf-8', 'replace'), workers=args.kafka_workers, callback=probe.on_message)
+    stream.start()
+    time.sleep(args.kafka_init_wait)
+    try:
+        for sz in [int(v) for v in args.sizes.split(',')]:
+            for rate in [int(v) for v in args.rates.split(',')]:
+                latency_run(args, swimlane, probe, sz, rate)
+    finally:
+        stream.stop()
+        task_deploy.deploy(swimlane, {"detect_anomalies": TASK}, TASKS)
+    print("kafka: %s" % json.dumps(dict(stream.stats), sort_keys=True))
+
+
 def write_main(args, creds):
     init_kafka(args)
 
@@ -104,10 +267,7 @@ def write_main(args, creds):
         } end.""" % (args.kafka_server, args.kafka_port, args.kafka_topic))
     assert ok == "ok", (ok, r)
 
-    q = TASK
-    print(q)
-    (ok, r) = swimlane.query(q)
-    assert ok == "ok", (ok, r)
+    task_deploy.deploy(swimlane, {"detect_anomalies": TASK}, TASKS, verbose=True)
 
     write_num(args, swimlane, args.blocks, args.sensors, args.pts, gen_data)
     (ok, r) = swimlane.insert([{'ns': int(time.time()) + 100, '0': 1}])
@@ -126,6 +286,10 @@ def main(args):
         creds = open_creds(args, CREDS)
         if args.write:
             r = write_main(args, creds)
+        elif args.deploy:
+            r = deploy_main(args, creds)
+        elif args.latency:
+            r = latency_main(args, creds)
         elif args.info:
             r = print_info(args, creds)
         else:
@@ -160,7 +324,17 @@ if __name__ == "__main__":
     parser.add_argument('-w','--write', help='Write data', required=False, action='store_true')
     parser.add_argument('-d','--delete', help='Clean data', required=False, action='store_true')
     parser.add_argument('-i','--info', help='Print info about test scenario/swimlane', required=False, action='store_true')
-
+    parser.add_argument('--deploy', help='Update the task of the test scenario if it has changed', required=False, action='store_true')
+    parser.add_argument('--all', help='Deploy to all test scenarios of the creds file', required=False, action='store_true')
+    parser.add_argument('--deploy_workers', type=int, help="Number of concurrent deploys", required=False, default=8)
+    parser.add_argument('--dry_run', help='Only print what a deploy would change', required=False, action='store_true')
+
+    parser.add_argument('--latency', help='Measure the latency from a write to its Kafka alert', required=False, action='store_true')
+    parser.add_argument('--sizes', help='Task window sizes (sz) to measure, separated by ,', required=False, default='10')
+    parser.add_argument('--rates', help='Write rates (points per second) to measure, separated by ,', required=False, default='10,100')
+    parser.add_argument('--latency_duration', help='Seconds of writes per size and rate', required=False, type=int, default=60)
+    parser.add_argument('--anomaly_every', help='Inject an outlier in every N-th window', required=False, type=int, default=1)
+    parser.add_argument('--latency_drain', help='Seconds to wait for alerts after the writes', required=False, type=int, default=10)
     parser.add_argument('--blocks', type=int, help="number of blocks", default=10)
     parser.add_argument('--pts', type=int, help="number of points per block", default=10)
     parser.add_argument('--sensors', type=int, help="number of sensors", required=False, default=1)
@@ -176,6 +350,11 @@ if __name__ == "__main__":
     parser.add_argument('--kafka_init_wait', help='Wait for consumer to get ready for seconds', required=False, type=int, default=5)
     parser.add_argument('--kafka_points', help='Send N data points', required=False, type=int, default=11)
     parser.add_argument('--kafka_id', help='Kafka test ID (also the suffix of the Kafka topic)', required=False, default='')
+    parser.add_argument('--kafka_group', help='Kafka consumer group (shares partitions with other consumers of the group)', required=False, default='')
+    parser.add_argument('--kafka_consumers', help='Number of consumers of the group in this process', required=False, type=int, default=1)
+    parser.add_argument('--kafka_max_records', help='Max records of a poll', required=False, type=int, default=500)
+    parser.add_argument('--kafka_workers', help='Number of message decoding threads', required=False, type=int, default=4)
+    parser.add_argument('--kafka_queue', help='Max number of read and not yet processed messages', required=False, type=int, default=10000)
     parser.add_argument('--kafka_ack', help='Request acknowledgments', required=False, type=int, choices=[0, 1], default=1)
 
     args = parser.parse_args()
@@ -194,8 +373,9 @@ if __name__ == "__main__":
     try:
         main(args)
     except KeyboardInterrupt:
-        if consumer != None:
-            consumer.join(args.kafka_consumer_wait / 1000.0)
+        if kafka_consumer != None:
+            kafka_consumer.stop()
+            kafka_consumer.join(args.kafka_consumer_wait / 1000.0)
         raise
     except ConnectionError as e:
         print(e)